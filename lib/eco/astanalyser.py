@@ -123,6 +123,10 @@ class AstAnalyser(object):
         if node is None:
             return
 
+        if getattr(node, "isolated", False):
+            # subtree around a syntax error (see IncParser.inc_parse)
+            return
+
         if hasattr(node, 'alternate') and node.alternate:
             node = node.alternate
 
@@ -28,6 +28,9 @@ class ATerms:
     def to_term(self, node):
         if node is None:
             return
+        if getattr(node, "isolated", False):
+            # subtree around a syntax error (see IncParser.inc_parse)
+            return
         from grammar_parser.bootstrap import AstNode, ListNode
         if isinstance(node, AstNode):
             return self.process_astnode(node)
@@ -63,6 +66,8 @@ class ATerms:
 
     def process_nonterm(self, node):
         from grammar_parser.bootstrap import AstNode, ListNode
+        if node.height > 0 and not isinstance(node.alternate, ListNode):
+            return self.process_sequence(node)
         if not isinstance(node, AstNode) and not isinstance(node, ListNode) and node.alternate:
             return self.to_term(node.alternate)
         s = []
@@ -77,6 +82,28 @@ class ATerms:
         s.append(")")
         return "".join(s)
 
+    def process_sequence(self, node):
+        # balanced list node (see IncParser.set_balanced_sequences): print the
+        # left-recursive chain A(A(B), B) of the unbalanced tree instead
+        elements = []
+        todo = [node]
+        while todo:
+            n = todo.pop()
+            if n.symbol.name == node.symbol.name:
+                todo.extend(reversed(n.children))
+            else:
+                elements.append(n)
+        term = None
+        for e in elements:
+            children = []
+            if term is not None:
+                children.append(term)
+            text = self.to_term(e)
+            if text:
+                children.append(text)
+            term = "%s(%s)" % (node.symbol.name, ", ".join(children))
+        return term
+
     def process_term(self, node):
         s = []
         s.append(node.lookup)
@@ -61,6 +61,7 @@ class BootstrapParser(object):
         from grammars.eco_grammar import eco_grammar as grammar
         self.lexer = IncrementalLexer(grammar.priorities)
         self.parser = IncParser(grammar.grammar, 1, True)
+        self.parser.set_balanced_sequences(True) # see get_list_elements
         self.parser.init_ast()
         self.ast = self.parser.previous_version.parent
         self.treemanager = TreeManager()
@@ -101,34 +102,33 @@ class BootstrapParser(object):
             assert options.children[1].symbol.name == "precedences"
             self.parse_precedences(options.children[1])
 
+    def get_list_elements(self, node):
+        """Returns the elements of the list nonterminal `node` in order. The
+        list is either a left-recursive chain (A ::= A B | B) or a balanced
+        tree of list nodes (see IncParser.set_balanced_sequences)."""
+        name = node.symbol.name
+        elements = []
+        todo = [node]
+        while todo:
+            n = todo.pop()
+            if n.symbol.name == name:
+                todo.extend(reversed(n.children))
+            else:
+                elements.append(n)
+        return elements
+
     def parse_settings(self, options):
-        if options.children == []:
-            return
-        if len(options.children) == 2:
-            more = options.children[0]
-            self.parse_settings(more)
-            option = options.children[1]
-        else:
-            option = options.children[0]
-        name = option.children[2].symbol.name
-        choice = option.children[6]
-        assert choice.symbol.name == "choice"
-        self.options[name] = choice.children[0].symbol.name
+        for option in self.get_list_elements(options):
+            name = option.children[2].symbol.name
+            choice = option.children[6]
+            assert choice.symbol.name == "choice"
+            self.options[name] = choice.children[0].symbol.name
 
     def parse_precedences(self, precedences):
-        if precedences.children == []:
-            return
-        # recursively parse other precedences
-        if len(precedences.children) == 2:
-            more = precedences.children[0]
-            self.parse_precedences(more)
-            precedence = precedences.children[1]
-        else:
-            precedence = precedences.children[0]
-        # parse single precedence
-        name = precedence.children[0].symbol.name
-        terminals = self.parse_precedence_symbols(precedence.children[2])
-        self.precedences.append((name, terminals))
+        for precedence in self.get_list_elements(precedences):
+            name = precedence.children[0].symbol.name
+            terminals = self.parse_precedence_symbols(precedence.children[2])
+            self.precedences.append((name, terminals))
 
     def parse_precedence_symbols(self, symbol):
         s = []
@@ -227,22 +227,15 @@ class BootstrapParser(object):
             return c.symbol.name[1:-1]
 
     def parse_symbols(self, node):
-        if node.children[0].symbol.name == "symbols":
-            symbols = self.parse_symbols(node.children[0])
-            symbol = self.parse_symbol(node.children[1])
-            if isinstance(symbol, AnySymbol) and symbols[-1].name == "WS":
+        symbols = []
+        for element in self.get_list_elements(node):
+            symbol = self.parse_symbol(element)
+            if isinstance(symbol, AnySymbol) and symbols and symbols[-1].name == "WS":
                 symbols.pop()
             symbols.append(symbol)
             if (isinstance(symbol, Terminal) or isinstance(symbol, MagicTerminal)) and self.implicit_ws() and self.current_rulename != "comment":
                 symbols.append(Nonterminal("WS"))
-            return symbols
-        elif node.children[0].symbol.name == "symbol":
-            l = []
-            symbol = self.parse_symbol(node.children[0])
-            l.append(symbol)
-            if isinstance(symbol, Terminal) and self.implicit_ws() and self.current_rulename != "comment":
-                l.append(Nonterminal("WS"))
-            return l
+        return symbols
 
     def parse_symbol(self, node):
         node = node.children[0]
@@ -375,11 +368,8 @@ class BootstrapParser(object):
             self.inclexer.indentation_based = True
 
     def parse_lexer(self, lexer):
-        if lexer.children[0].symbol.name == "lrule":
-            self.parse_lrule(lexer.children[0])
-        elif lexer.children[0].symbol.name == "lexer":
-            self.parse_lexer(lexer.children[0])
-            self.parse_lrule(lexer.children[1])
+        for lrule in self.get_list_elements(lexer):
+            self.parse_lrule(lrule)
 
     def parse_lrule(self, lrule):
         assert lrule.children[0].symbol.name == "tokenname"
@@ -411,12 +401,13 @@ class AstNode(object):
     def __repr__(self):
         return "AstNode(%s, %s)" % (self.name, self.children)
 
-    def __getattribute__(self, name):
-        if name == "symbol":
-            return self
-        if name == "changed":
-            return False
-        return object.__getattribute__(self, name)
+    @property
+    def symbol(self):
+        return self
+
+    @property
+    def changed(self):
+        return False
 
     def get(self, name):
         if self.children.has_key(name):
@@ -539,22 +530,49 @@ class ListExpr(Expr):
         return ListNode(name, l)
 
 class ListNode(object):
-    def __init__(self, name, l):
+    """List of AST nodes. Concatenating two lists creates a list that shares
+    both operands, whose elements are only copied into a single list once
+    its children are accessed."""
+    def __init__(self, name, l, parts=None):
         self.name = name
-        self.children = l
+        self._children = l
+        self.parts = parts
+
+    def get_children(self):
+        if self._children is None:
+            self._children = self.flatten()
+            self.parts = None
+        return self._children
+
+    def set_children(self, l):
+        self._children = l
+        self.parts = None
+
+    children = property(get_children, set_children)
+
+    def flatten(self):
+        l = []
+        todo = [self]
+        while todo:
+            node = todo.pop()
+            if node._children is not None:
+                l.extend(node._children)
+            else:
+                todo.extend(reversed(node.parts))
+        return l
 
     def __add__(self, other):
         if isinstance(other, ListNode):
-            l = self.children + other.children
-            return ListNode(self.name, l)
+            return ListNode(self.name, None, (self, other))
         raise TypeError("cannot concatenate ListNode and %s" % type(other))
 
-    def __getattribute__(self, name):
-        if name == "symbol":
-            return self
-        if name == "changed":
-            return False
-        return object.__getattribute__(self, name)
+    @property
+    def symbol(self):
+        return self
+
+    @property
+    def changed(self):
+        return False
 
     def __repr__(self):
         return "ListNode(%s, %s)" % (self.name, self.children)
@@ -42,11 +42,21 @@ class Rule(object):
         return "Rule(%s => %s)" % (self.symbol, self.alternatives)
 
 class Symbol(object):
+    _hash = None # cached hash, reset by set_name
+
     def __init__(self, name="", folding=None):
         self.name = name
         self.folding = folding
 
+    def set_name(self, name):
+        """Renames the symbol. Symbols that may have been hashed already must
+        be renamed this way, so their cached hash is dropped."""
+        self.name = name
+        self._hash = None
+
     def __eq__(self, other):
+        if other is self:
+            return True
         if other.__class__ != self.__class__:
             return False
         return self.name == other.name
@@ -54,9 +64,17 @@ class Symbol(object):
     def __ne__(self, other):
         return not self == other
 
+    def __getstate__(self):
+        # don't pickle the cached hash
+        state = self.__dict__.copy()
+        state.pop("_hash", None)
+        return state
+
     def __hash__(self):
-        #XXX unsafe hashfunction
-        return hash(self.__class__.__name__ + self.name)
+        if self._hash is None:
+            #XXX unsafe hashfunction
+            self._hash = hash(self.__class__.__name__ + self.name)
+        return self._hash
 
     def copy(self):
         return self.__class__(self.name, self.folding)
@@ -93,9 +111,30 @@ class Epsilon(Symbol):
     def __repr__(self):
         return self.__class__.__name__
 
-    def __hash__(self):
-        #XXX why doesn't Epsilon inherit this method from Symbol!?
-        return hash(self.__class__.__name__ + self.name)
+    #XXX why doesn't Epsilon inherit this method from Symbol!?
+    __hash__ = Symbol.__hash__
+
+_interned = {}
+def intern_symbol(cls, name=None):
+    """Returns the canonical instance of a symbol, which is created only once
+    per class and name. Interned symbols are shared and can be compared by
+    identity, so they must never be altered or used inside a parse tree."""
+    try:
+        return _interned[(cls, name)]
+    except KeyError:
+        if name is None:
+            symbol = cls()
+        else:
+            symbol = cls(name)
+        _interned[(cls, name)] = symbol
+        return symbol
+
+def intern_name(name):
+    """Interns the name of a token, so dictionary lookups using names coming
+    from the lexer only need to compare identities."""
+    if isinstance(name, str):
+        return intern(name)
+    return name
 
 class ExtendedSymbol(object):
 
@@ -168,6 +168,26 @@ class Test_Bootstrapping(object):
         test_grammar = """S ::= A {If(child1=#1, child2=[#3, #4])}; A ::= \"a\"; %% a:\"a\""""
         bootstrap.parse(test_grammar)
 
+    def test_long_lists(self):
+        # symbols and lexer rules are lists, which the parser builds as
+        # balanced trees instead of left-recursive chains
+        names = ["t%s" % i for i in range(40)]
+        test_grammar = "S ::= %s; %%%% %s" % (" ".join(['"%s"' % n for n in names]),
+                                             " ".join(['%s:"%s"' % (n, n) for n in names]))
+        bootstrap = BootstrapParser(lr_type=1, whitespaces=False)
+        bootstrap.parse(test_grammar)
+        assert "symbols" in [s[0].name for s in bootstrap.parser.sequences.values()]
+        assert bootstrap.rules[Nonterminal("S")].alternatives == [[Terminal(n) for n in names]]
+        assert [name for name, regex in bootstrap.lrules] == names
+
+        # implicit whitespace only follows terminals
+        test_grammar = 'S ::= A "x" A; A ::= "a"; %% x:"x" a:"a"'
+        bootstrap = BootstrapParser(lr_type=1, whitespaces=True)
+        bootstrap.parse(test_grammar)
+        WS = Nonterminal("WS")
+        assert bootstrap.rules[Nonterminal("S")].alternatives == [[Nonterminal("A"), Terminal("x"), WS, Nonterminal("A")]]
+        assert bootstrap.rules[Nonterminal("A")].alternatives == [[Terminal("a"), WS]]
+
     def test_bootstrapping1(self):
         bootstrap = BootstrapParser(lr_type=1, whitespaces=False)
         test_grammar = 'S ::= "abc"; %% abc:\"abc\"'
@@ -308,3 +328,23 @@ comma:","
         E = root.children[1]
         assert E.alternate.symbol.name == "a"
 
+
+class Test_ListNode(object):
+
+    def test_add(self):
+        a = ListNode("items", [1])
+        b = a + ListNode("items", [2])
+        c = b + ListNode("items", [3, 4])
+        assert c.parts[0] is b
+        assert c.children == [1, 2, 3, 4]
+        assert b.children == [1, 2]
+        assert a.children == [1]
+        assert c.name == "items"
+        assert c.symbol is c
+        assert c.changed == False
+
+    def test_long_list(self):
+        l = ListNode("items", [])
+        for i in range(10000):
+            l = l + ListNode("items", [i])
+        assert l.children == range(10000)
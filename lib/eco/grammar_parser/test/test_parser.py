@@ -19,7 +19,7 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 
-from grammar_parser.gparser import Parser, Nonterminal, Terminal, Epsilon
+from grammar_parser.gparser import Parser, Nonterminal, Terminal, Epsilon, intern_symbol
 
 
 def test_terminal():
@@ -31,6 +31,20 @@ def test_terminal():
     t2 = Terminal("a")
     assert t1 == t2
 
+def test_symbol_hash():
+    t = Terminal("a")
+    assert hash(t) == hash(Terminal("a"))
+    t.set_name("b")
+    assert hash(t) == hash(Terminal("b"))
+    assert hash(Epsilon()) == hash(Epsilon())
+
+def test_intern_symbol():
+    t = intern_symbol(Terminal, "a")
+    assert t is intern_symbol(Terminal, "a")
+    assert t == Terminal("a")
+    assert intern_symbol(Epsilon) is intern_symbol(Epsilon)
+    assert intern_symbol(Epsilon) == Epsilon()
+
 def test_simple():
     p = Parser("E ::= \"a\"")
     p.parse()
@@ -48,6 +48,7 @@ class EcoFile(object):
         self.base = base
         self.alts = {}
         self.extract = None
+        self.balanced = False
 
     def load(self):
         from grammar_parser.bootstrap import BootstrapParser
@@ -72,6 +73,7 @@ class EcoFile(object):
             from incparser.incparser import IncParser
             incparser = IncParser()
             incparser.from_dict(bootstrap.rules, None, None, whitespace, pickle_id, None)
+            incparser.set_balanced_sequences(self.balanced)
             incparser.init_ast()
 
             inclexer = _cache[self.name + "::lexer"]
@@ -90,6 +92,7 @@ class EcoFile(object):
             bootstrap.read_options()
 
             bootstrap.create_parser(pickle_id)
+            bootstrap.incparser.set_balanced_sequences(self.balanced)
             whitespace = bootstrap.implicit_ws()
 
             bootstrap.create_lexer()
@@ -109,6 +112,12 @@ class EcoFile(object):
     def change_start(self, name):
         self.extract = name
 
+    def balance_lists(self):
+        # build plain lists as balanced trees (see
+        # IncParser.set_balanced_sequences); only for grammars whose tree
+        # consumers don't walk lists by position
+        self.balanced = True
+
     def __str__(self):
         return self.name
 
@@ -124,6 +133,7 @@ from eco_grammar import eco_grammar # needed to edit EcoGrammar
 calc = EcoFile("Basic Calculator", "grammars/basiccalc.eco", "Calc")
 java = EcoFile("Java 1.5", "grammars/java15.eco", "Java")
 python = EcoFile("Python 2.7.5", "grammars/python275.eco", "Python")
+python.balance_lists()
 ipython = EcoFile("IPython", "grammars/python275.eco", "IPython")
 prolog = EcoFile("Prolog", "grammars/prolog.eco", "Prolog")
 scoping = EcoFile("Scoping Rules (Ecofile)", "grammars/scoping_grammar.eco", "Scoping")
@@ -20,7 +20,7 @@
 # IN THE SOFTWARE.
 
 from grammar_parser.plexer import PriorityLexer
-from grammar_parser.gparser import MagicTerminal, Terminal, IndentationTerminal
+from grammar_parser.gparser import MagicTerminal, Terminal, IndentationTerminal, intern_name
 from incparser.astree import BOS, EOS, TextNode, ImageNode
 from PyQt4.QtGui import QImage
 import re, os
@@ -173,7 +173,7 @@ class IncrementalLexer(object):
                         old_node.image_src = None
                 else:
                     additional_node = TextNode(Terminal(match[0]), -1, [], -1)
-                additional_node.lookup = match[1]
+                additional_node.lookup = intern_name(match[1])
                 old_node.prev_term.parent.insert_after_node(old_node.prev_term, additional_node)
                 #self.add_node(old_node.prev_term, additional_node)
                 old_x += 0
@@ -185,8 +185,9 @@ class IncrementalLexer(object):
                 new_x  += len(match[0])
                 debug_old.append(old_node.symbol.name)
                 debug_new.append(match[0])
-                old_node.symbol.name = match[0]
-                old_node.lookup = match[1]
+                old_node.symbol.set_name(match[0])
+                old_node.lookup = intern_name(match[1])
+                old_node.invalidate_text()
 
                 if self.language == "Chemicals":
                     filename = "chemicals/" + old_node.symbol.name + ".png"
@@ -221,7 +222,7 @@ class IncrementalLexer(object):
         # if ndoe itself is a newline it won't be relexed, so do it manually
         if startnode.symbol.name == "\r":
             result = self.lex(startnode.symbol.name)
-            startnode.lookup = result[0][1]
+            startnode.lookup = intern_name(result[0][1])
 
         if isinstance(startnode.symbol, IndentationTerminal):
             startnode = startnode.next_term
@@ -293,7 +294,7 @@ class IncrementalLexer(object):
                         old_node.image_src = None
                 else:
                     additional_node = TextNode(Terminal(match[0]), -1, [], -1)
-                additional_node.lookup = match[1]
+                additional_node.lookup = intern_name(match[1])
                 old_node.prev_term.parent.insert_after_node(old_node.prev_term, additional_node)
                 #self.add_node(old_node.prev_term, additional_node)
                 old_x += 0
@@ -305,8 +306,9 @@ class IncrementalLexer(object):
                 new_x  += len(match[0])
                 debug_old.append(old_node.symbol.name)
                 debug_new.append(match[0])
-                old_node.symbol.name = match[0]
-                old_node.lookup = match[1]
+                old_node.symbol.set_name(match[0])
+                old_node.lookup = intern_name(match[1])
+                old_node.invalidate_text()
 
                 if self.language == "Chemicals":
                     filename = "chemicals/" + old_node.symbol.name + ".png"
@@ -344,7 +346,7 @@ class IncrementalLexer(object):
         for match in success:
             node = TextNode(Terminal(match[0]))
             node.version = version
-            node.lookup = match[1]
+            node.lookup = intern_name(match[1])
             parent.children.append(node)
             last_node.next_term = node
             last_node.right = node
@@ -423,7 +425,7 @@ class IncrementalLexerCF(object):
         for match in success:
             node = TextNode(Terminal(match[0]))
             node.version = version
-            node.lookup = match[1]
+            node.lookup = intern_name(match[1])
             parent.children.append(node)
             last_node.next_term = node
             last_node.right = node
@@ -485,19 +487,7 @@ class IncrementalLexerCF(object):
                 read_nodes.append(current_node)
                 break
             read += len(token.source)
-            # special case when inserting a newline into a string, the lexer
-            # creates a single token. We need to make sure that that newline
-            # gets lexed into its own token
-            if len(token.source) > 1 and token.source.find("\r") >= 0:
-                l = token.source.split("\r")
-                for e in l:
-                    t = self.lexer.tokenize(e)
-                    generated_tokens.extend(t)
-                    if e is not l[-1]:
-                        newline = self.lexer.tokenize("\r")
-                        generated_tokens.extend(newline)
-            else:
-                generated_tokens.append(token)
+            self.add_token(generated_tokens, token)
             while read > pos + len(current_node.symbol.name):
                 pos += len(current_node.symbol.name)
                 read_nodes.append(current_node)
@@ -510,20 +500,53 @@ class IncrementalLexerCF(object):
 
         return self.merge_back(read_nodes, generated_tokens)
 
+    def add_token(self, tokens, token):
+        # special case when inserting a newline into a string, the lexer
+        # creates a single token. We need to make sure that that newline
+        # gets lexed into its own token
+        if len(token.source) > 1 and token.source.find("\r") >= 0:
+            l = token.source.split("\r")
+            for i, e in enumerate(l):
+                tokens.extend(self.lexer.tokenize(e))
+                if i < len(l) - 1:
+                    tokens.extend(self.lexer.tokenize("\r"))
+        else:
+            tokens.append(token)
+
+    def relex_pasted(self, node):
+        """Relexes `node` after a large text has been inserted into it. The
+        text is lexed as a plain string together with the tokens around it
+        on the same line, instead of munching it through a StringWrapper."""
+        read_nodes = self.find_preceeding_nodes(node)
+        read_nodes.append(node)
+        end = node.next_term
+        while not (isinstance(end, EOS) or isinstance(end.symbol, IndentationTerminal)
+                   or isinstance(end.symbol, MagicTerminal) or end.symbol.name == "\r"):
+            read_nodes.append(end)
+            end = end.next_term
+        text = "".join([n.symbol.name for n in read_nodes])
+        if text == "":
+            return False
+        generated_tokens = []
+        for token in self.lexer.tokenize(text):
+            self.add_token(generated_tokens, token)
+        return self.merge_back(read_nodes, generated_tokens)
+
     def merge_back(self, read_nodes, generated_tokens):
 
         any_changes = False
+        if len(generated_tokens) > len(read_nodes):
+            # splice the nodes for all additional tokens into the tree at once
+            new_nodes = [TextNode(Terminal("")) for i in range(len(generated_tokens) - len(read_nodes))]
+            last_node = read_nodes[-1]
+            last_node.parent.insert_nodes_after(last_node, new_nodes)
+            read_nodes = read_nodes + new_nodes
+            any_changes = True
         # insert new nodes into tree
         it = iter(read_nodes)
         for t in generated_tokens:
-            try:
-                node = it.next()
-            except StopIteration:
-                node = TextNode(Terminal(""))
-                last_node.insert_after(node)
-                any_changes = True
-            last_node = node
-            node.symbol.name = t.source
+            node = it.next()
+            node.symbol.set_name(t.source)
             node.indent = None
             if node.lookup != t.name:
                 node.mark_changed()
@@ -548,7 +571,7 @@ class IncrementalLexerCF(object):
             if node.lookup == "\\" and node.next_term.lookup == "<return>":
                 node.next_term.mark_changed()
                 any_changes = True
-            node.lookup = t.name
+            node.lookup = intern_name(t.name)
             node.lookahead = t.lookahead
         # delete left over nodes
         while True:
@@ -605,7 +628,7 @@ class StringWrapper(object):
             if isinstance(node, EOS):
                 raise IndexError
         if node.next_term and (isinstance(node.next_term, EOS) or isinstance(node.next_term.symbol, IndentationTerminal) or node.next_term.symbol.name == "\r" or isinstance(node.next_term.symbol, MagicTerminal)):
-            self.length = startindex + len(node.symbol.name[index:])
+            self.length = startindex + len(node.symbol.name) - index
         return node.symbol.name[index]
 
     def __getslice__(self, start, stop):
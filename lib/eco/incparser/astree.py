@@ -20,7 +20,8 @@
 # IN THE SOFTWARE.
 
 import re
-from grammar_parser.gparser import Nonterminal, Terminal, IndentationTerminal
+from bisect import bisect_left, bisect_right
+from grammar_parser.gparser import Nonterminal, Terminal, MagicTerminal, IndentationTerminal
 from syntaxtable import FinishSymbol
 
 class AST(object):
@@ -43,29 +44,22 @@ class AST(object):
     def get_nodes_at_position(self, pos, a=None, b=None):
         """
         Searches all nodes that match the current cursor position in the TextField.
-        As a side effect all passed nodes are updated with their position in the document.
+        As a side effect the found nodes are updated with their position in the document.
         """
-        print("================== get nodes at pos ================== ")
-        progress = 0
-        node = self.parent.children[0]
-        while node is not None:
-            node.position = progress
-            progress += len(node.symbol.name)
-
-            print("node", node)
-            if pos < progress:
-                return [node, None]
-
-            if pos == progress:
-                print("pos == progress")
-                other = node.next_terminal()
-                print("other", other)
-                other.position = progress
-                return [node, other]
-
-            node = node.next_terminal()
-        print ("================ end get nodes at pos ================ ")
-
+        if pos == 0:
+            node = self.parent.children[0]
+            start = 0
+        else:
+            node, start = self.find_node_at_offset(pos - 1)
+            if node is None:
+                return None
+        node.position = start
+        end = start + node.text_length()
+        if pos < end:
+            return [node, None]
+        other = node.next_terminal()
+        other.position = end
+        return [node, other]
 
     def get_nodes_at_position_old(self, pos, node=None, bla=0):
         print("Progress:", self.progress, "Node", node)
@@ -89,19 +83,112 @@ class AST(object):
             self.progress += len(node.symbol.name)
             return nodes
 
-    def find_node_at_pos(self, pos, node=None): #recursive
+    def find_node_at_pos(self, pos):
+        return self.find_node_at_offset(pos)[0]
+
+    def find_node_at_offset(self, offset):
+        """Returns the terminal containing the character at the given offset
+        of the exported text, and the offset at which the terminal starts.
+        Uses the text lengths cached in the nonterminals, so only the path to
+        the terminal is visited. Long lists can be kept balanced by the parser
+        (see IncParser.set_balanced_sequences), so that path only grows
+        logarithmically with their length, and the children of wide nodes,
+        like a root flattened by a failed parse, are found by bisecting the
+        offsets at which they start (see TextNode.update_text_cache)."""
+        node = self.parent
+        start = 0
+        while True:
+            if isinstance(node.symbol, MagicTerminal):
+                node = node.symbol.ast
+            if node.textlength is None:
+                node.update_text_cache()
+            if node.starts is not None:
+                _, lengths, _ = node.starts
+                i = bisect_right(lengths, offset - start) - 1
+                c = node.children[i]
+                if offset >= start + lengths[i] + c.text_length():
+                    return None, None
+                start += lengths[i]
+                node = c
+            else:
+                for c in node.children:
+                    length = c.text_length()
+                    if offset < start + length:
+                        node = c
+                        break
+                    start += length
+                else:
+                    return None, None
+            if not isinstance(node.symbol, Nonterminal) and not isinstance(node.symbol, MagicTerminal):
+                return node, start
+
+    def get_offset(self, node):
+        """Returns the offset at which the text of the given node starts. The
+        parents add up the lengths of the node's left siblings (see
+        TextNode.get_prefix), so each level costs a lookup or a bounded walk,
+        even on a root that holds all terminals after a failed parse."""
+        offset = 0
+        while node is not None:
+            if node.parent is not None:
+                offset += node.parent.get_prefix(node)[0]
+            node = node.get_parent()
+        return offset
+
+    def get_line_offset(self, line):
+        """Returns the offset at which the given line starts."""
+        if line == 0:
+            return 0
+        node = self.parent
+        offset = 0
+        while True:
+            if isinstance(node.symbol, MagicTerminal):
+                node = node.symbol.ast
+            if node.textlength is None:
+                node.update_text_cache()
+            if node.starts is not None:
+                # wide node: find the child in which the line starts
+                _, lengths, lines = node.starts
+                i = bisect_left(lines, line) - 1
+                c = node.children[i]
+                if line > lines[i] + c.newline_count():
+                    return None
+                line -= lines[i]
+                offset += lengths[i]
+                node = c
+            else:
+                for c in node.children:
+                    newlines = c.newline_count()
+                    if line <= newlines:
+                        node = c
+                        break
+                    line -= newlines
+                    offset += c.text_length()
+                else:
+                    return None
+            if not isinstance(node.symbol, Nonterminal) and not isinstance(node.symbol, MagicTerminal):
+                i = -1
+                for _ in range(line):
+                    i = node.symbol.name.index("\r", i + 1)
+                return offset + i + 1
+
+    def get_line_column(self, offset):
+        """Converts an offset into a line number and a column."""
+        node, start = self.find_node_at_offset(offset)
         if node is None:
-           node = self.parent.children[1]
-
-        if isinstance(node.symbol, Nonterminal):
-            for child in node.children:
-                result = self.find_node_at_pos(pos, child)
-                if result:
-                    return result
-
-        if node.pos + len(node.symbol.name) >= pos:
-            return node
+            line = self.parent.newline_count()
+        else:
+            line = self.get_newlines_before(node) + node.symbol.name.count("\r", 0, offset - start)
+        return line, offset - self.get_line_offset(line)
 
+    def get_newlines_before(self, node):
+        """Returns the number of newlines before the given node (see
+        get_offset)."""
+        newlines = 0
+        while node is not None:
+            if node.parent is not None:
+                newlines += node.parent.get_prefix(node)[1]
+            node = node.get_parent()
+        return newlines
 
     def find_node_at_pos_iterative(self, pos): #not working
         stack = []
@@ -152,8 +239,144 @@ class AST(object):
         self.parent.cprint(output)
         return "\n".join(output)
 
+class History(object):
+    """Values of a node's fields in the versions the node was saved in. Each
+    field only records the versions in which its value changed, so lookups can
+    bisect them. Lists of children are stored as the difference to the
+    previous list, plus a full copy whenever the differences since the last
+    copy add up to the length of the list."""
+
+    __slots__ = ["versions", "fields", "children_versions", "children", "last_children", "pending"]
+
+    def __init__(self):
+        self.versions = [] # versions the node was saved in
+        self.fields = {} # name -> (versions, values)
+        self.children_versions = []
+        self.children = [] # full copies (lists) or deltas (start, end, nodes)
+        self.last_children = [] # children of the latest saved version
+        self.pending = 0 # size of the deltas since the last full copy
+
+    def save(self, version, values, children):
+        self.truncate(version - 1)
+        self.versions.append(version)
+        for name, value in values:
+            try:
+                versions, old = self.fields[name]
+            except KeyError:
+                versions, old = self.fields[name] = ([], [])
+            if not old or old[-1] is not value:
+                versions.append(version)
+                old.append(value)
+        self.save_children(version, children)
+
+    def save_children(self, version, children):
+        last = self.last_children
+        if self.children_versions:
+            # only store the part of the list that changed
+            n = min(len(last), len(children))
+            start = 0
+            while start < n and last[start] is children[start]:
+                start += 1
+            if start == len(last) == len(children):
+                return
+            end, newend = len(last), len(children)
+            while end > start and newend > start and last[end-1] is children[newend-1]:
+                end -= 1
+                newend -= 1
+            delta = (start, end, children[start:newend])
+            self.pending += end - start + newend - start
+        if not self.children_versions or self.pending >= len(children):
+            delta = list(children)
+            self.pending = 0
+        self.children_versions.append(version)
+        self.children.append(delta)
+        self.last_children = list(children)
+
+    def find(self, version):
+        """Returns the latest version the node was saved in that is not newer
+        than `version`, or -1 if there is none."""
+        i = bisect_right(self.versions, version)
+        if i == 0:
+            return -1
+        return self.versions[i-1]
+
+    def get(self, name, version, default=None):
+        versions, values = self.fields[name]
+        i = bisect_right(versions, version)
+        if i == 0:
+            return default
+        return values[i-1]
+
+    def get_children(self, version):
+        i = bisect_right(self.children_versions, version)
+        if i == 0:
+            return []
+        return self.build_children(i - 1)
+
+    def build_children(self, i):
+        start = i
+        while not isinstance(self.children[start], list):
+            start -= 1
+        children = list(self.children[start])
+        for j in range(start + 1, i + 1):
+            (a, b, nodes) = self.children[j]
+            children[a:b] = nodes
+        return children
+
+    def truncate(self, version):
+        """Forgets all versions newer than `version`."""
+        if not self.versions or self.versions[-1] <= version:
+            return
+        del self.versions[bisect_right(self.versions, version):]
+        for versions, values in self.fields.values():
+            i = bisect_right(versions, version)
+            del versions[i:]
+            del values[i:]
+        i = bisect_right(self.children_versions, version)
+        del self.children_versions[i:]
+        del self.children[i:]
+        if i == 0:
+            self.last_children = []
+            self.pending = 0
+            return
+        self.last_children = self.build_children(i - 1)
+        self.update_pending()
+
+    def update_pending(self):
+        self.pending = 0
+        i = len(self.children) - 1
+        while not isinstance(self.children[i], list):
+            (a, b, nodes) = self.children[i]
+            self.pending += b - a + len(nodes)
+            i -= 1
+
+    def compact(self, version):
+        """Merges all versions up to `version` into one, so only the versions
+        after it can still be told apart. Returns the number of dropped
+        entries."""
+        i = bisect_right(self.versions, version) - 1
+        if i <= 0:
+            return 0
+        del self.versions[:i]
+        dropped = i
+        for versions, values in self.fields.values():
+            j = bisect_right(versions, version) - 1
+            if j > 0:
+                del versions[:j]
+                del values[:j]
+                dropped += j
+        j = bisect_right(self.children_versions, version) - 1
+        if j > 0:
+            if not isinstance(self.children[j], list):
+                self.children[j] = self.build_children(j)
+            del self.children_versions[:j]
+            del self.children[:j]
+            self.update_pending()
+            dropped += j
+        return dropped
+
 class Node(object):
-    __slots__ = ["symbol", "state", "parent", "left", "right", "prev_term", "next_term", "magic_parent", "children", "annotations"]
+    __slots__ = ["symbol", "state", "parent", "left", "right", "prev_term", "next_term", "magic_parent", "children", "annotations", "first_child"]
     def __init__(self, symbol, state, children):
         self.symbol = symbol
         self.state = state
@@ -188,6 +411,7 @@ class Node(object):
         self.log[("ns", TreeManager.version)] = True
 
     def mark_changed(self):
+        self.invalidate_text()
         node = self
         while True:
             node.save_ns()
@@ -204,6 +428,7 @@ class Node(object):
             node.changed = True
 
     def mark_version(self):
+        self.invalidate_text()
         node = self
         while True:
             node.save_ns()
@@ -218,6 +443,7 @@ class Node(object):
 
     def set_children(self, children):
         self.children = children
+        self.textlength = None
         last = None
         for c in children:
             c.parent = self
@@ -230,84 +456,238 @@ class Node(object):
             last.right = None # last child has no right sibling
             #XXX need to save this?
 
+    def __getattr__(self, name):
+        if name == "children":
+            return self.attach_children()
+        raise AttributeError(name)
+
+    def is_detached(self):
+        try:
+            Node.children.__get__(self)
+        except AttributeError:
+            return True
+        return False
+
+    def detach_children(self):
+        """Drops the list of children and only remembers the first child, so
+        children can be inserted and removed in constant time by updating the
+        sibling links. The list is rebuilt when it is accessed again."""
+        if self.is_detached():
+            return
+        if self.children:
+            self.first_child = self.children[0]
+        else:
+            self.first_child = None
+        del self.children
+
+    def attach_children(self):
+        children = []
+        node = self.first_child
+        while node is not None:
+            children.append(node)
+            node = node.right
+        self.children = children
+        return children
+
     def save(self, version):
-        self.log[("children", version)] = list(self.children)
-        self.log[("parent", version)] = self.parent
-        self.log[("left", version)] = self.left
-        self.log[("right", version)] = self.right
-        self.log[("next_term", version)] = self.next_term
-        self.log[("prev_term", version)] = self.prev_term
-        self.log[("deleted", version)] = self.deleted
-        self.log[("indent", version)] = self.indent
+        if self.history is None:
+            self.history = History()
+        self.history.save(version, self.get_saved_fields(), self.children)
         self.version = version
 
+    def get_saved_fields(self):
+        return [("parent", self.parent), ("left", self.left), ("right", self.right),
+                ("next_term", self.next_term), ("prev_term", self.prev_term),
+                ("deleted", self.deleted), ("indent", self.indent)]
+
     def load(self, version):
-        while version >= 0:
-            if ("parent", version) in self.log:
-                self.parent = self.log[("parent", version)]
-                self.children = list(self.log[("children", version)])
-                self.left = self.log[("left", version)]
-                self.right = self.log[("right", version)]
-                self.next_term = self.log[("next_term", version)]
-                self.prev_term = self.log[("prev_term", version)]
-                self.deleted = self.log[("deleted", version)]
-                self.indent = self.log[("indent", version)]
-                self.version = version
-                return
-            version -= 1
+        if self.history is None:
+            return
+        history = self.history
+        saved = history.find(version)
+        if saved == -1:
+            return
+        self.parent = history.get("parent", saved)
+        self.children = history.get_children(saved)
+        self.left = history.get("left", saved)
+        self.right = history.get("right", saved)
+        self.next_term = history.get("next_term", saved)
+        self.prev_term = history.get("prev_term", saved)
+        self.deleted = history.get("deleted", saved)
+        self.indent = history.get("indent", saved)
+        self.version = saved
 
     def remove_child(self, child):
-        for i in xrange(len(self.children)):
-            if self.children[i] is child:
-                removed_child = self.children.pop(i)
-                removed_child.deleted = True
-                removed_child.save_ns()
-                # update siblings
-                if removed_child.left:
-                    removed_child.left.right = removed_child.right
-                    removed_child.left.save_ns()
-                if removed_child.right:
-                    removed_child.right.left = removed_child.left
-                    removed_child.right.save_ns()
-                # update terminal pointers
-                child.prev_term.next_term = child.next_term
-                child.prev_term.save_ns()
-                child.prev_term.mark_version()
-                child.next_term.prev_term = child.prev_term
-                child.next_term.save_ns()
-                child.next_term.mark_version()
-                self.mark_changed()
-                self.changed = True
-                return
+        if child.parent is not self:
+            return
+        self.detach_children()
+        if self.first_child is child:
+            self.first_child = child.right
+        child.deleted = True
+        child.save_ns()
+        # update siblings
+        if child.left:
+            child.left.right = child.right
+            child.left.save_ns()
+        if child.right:
+            child.right.left = child.left
+            child.right.save_ns()
+        # update terminal pointers
+        child.prev_term.next_term = child.next_term
+        child.prev_term.save_ns()
+        child.prev_term.mark_version()
+        child.next_term.prev_term = child.prev_term
+        child.next_term.save_ns()
+        child.next_term.mark_version()
+        self.mark_changed()
+        self.changed = True
+
+    def remove_terminals(self, last):
+        """Removes the run of terminals from this node up to `last` (following
+        next_term). Unlike calling remove_child for each of them, the terminal
+        links around the run are only updated and each parent only marked as
+        changed once."""
+        prev_term = self.prev_term
+        next_term = last.next_term
+        parents = []
+        seen = set()
+        node = self
+        while True:
+            parent = node.parent
+            parent.save_ns()
+            parent.detach_children()
+            if parent.first_child is node:
+                parent.first_child = node.right
+            node.deleted = True
+            node.save_ns()
+            # update siblings
+            if node.left:
+                node.left.right = node.right
+                node.left.save_ns()
+            if node.right:
+                node.right.left = node.left
+                node.right.save_ns()
+            if id(parent) not in seen:
+                seen.add(id(parent))
+                parents.append(parent)
+            if node is last:
+                break
+            node = node.next_term
+        # update terminal pointers
+        prev_term.next_term = next_term
+        prev_term.save_ns()
+        prev_term.mark_version()
+        next_term.prev_term = prev_term
+        next_term.save_ns()
+        next_term.mark_version()
+        # Subtrees that are left without terminals are removed as well.
+        # Otherwise every parse would have to walk over all of them to find
+        # the lookahead of an empty nonterminal (see find_first_terminal).
+        empty = {}
+        changed = []
+        for parent in parents:
+            # mark the whole path to the parent before it is pruned, so its
+            # changes can be found again from the root (see
+            # TreeManager.recover_version)
+            parent.mark_version()
+            node = parent
+            while node.parent is not None and node.parent.has_no_terminals(empty):
+                node = node.parent
+            if node.parent is not None and node.has_no_terminals(empty):
+                if not node.deleted:
+                    node.parent.remove_nonterminal(node)
+                node = node.parent
+            changed.append(node)
+        for node in changed:
+            node.mark_changed()
+            node.changed = True
+
+    def has_no_terminals(self, memo):
+        """Returns True if this node's subtree doesn't contain any terminals.
+        Results are stored in `memo`."""
+        if not isinstance(self.symbol, Nonterminal):
+            return False
+        try:
+            return memo[id(self)]
+        except KeyError:
+            pass
+        result = True
+        for child in self.children:
+            if not child.has_no_terminals(memo):
+                result = False
+                break
+        memo[id(self)] = result
+        return result
+
+    def remove_nonterminal(self, child):
+        self.save_ns()
+        self.detach_children()
+        if self.first_child is child:
+            self.first_child = child.right
+        child.deleted = True
+        child.save_ns()
+        if child.left:
+            child.left.right = child.right
+            child.left.save_ns()
+        if child.right:
+            child.right.left = child.left
+            child.right.save_ns()
 
     def insert_after(self, node):
         self.parent.insert_after_node(self, node)
 
     def insert_after_node(self, node, newnode):
-        i = 0
-        for c in self.children:
-            if c is node:
-                self.children.insert(i+1, newnode)
-                newnode.parent = self
-                newnode.mark_changed()
-                # update siblings
-                newnode.left = c
-                newnode.right = c.right
-                c.right = newnode
-                c.save_ns()
-                if newnode.right:
-                    newnode.right.left = newnode
-                    newnode.right.save_ns()
-                # update terminal pointers
-                newnode.prev_term = node
-                node.next_term.prev_term = newnode
-                node.next_term.save_ns()
-                node.next_term.mark_version()
-                newnode.next_term = node.next_term
-                node.next_term = newnode
-                newnode.magic_parent = node.magic_parent
-                return
-            i += 1
+        if node.parent is not self:
+            return
+        self.detach_children()
+        newnode.parent = self
+        newnode.mark_changed()
+        # update siblings
+        newnode.left = node
+        newnode.right = node.right
+        node.right = newnode
+        node.save_ns()
+        if newnode.right:
+            newnode.right.left = newnode
+            newnode.right.save_ns()
+        # update terminal pointers
+        newnode.prev_term = node
+        node.next_term.prev_term = newnode
+        node.next_term.save_ns()
+        node.next_term.mark_version()
+        newnode.next_term = node.next_term
+        node.next_term = newnode
+        newnode.magic_parent = node.magic_parent
+
+    def insert_nodes_after(self, node, newnodes):
+        """Inserts a run of new terminals after `node`. Unlike calling
+        insert_after_node for each of them, the links around the run are only
+        updated and the ancestors only marked as changed once."""
+        if node.parent is not self or not newnodes:
+            return
+        self.detach_children()
+        right = node.right
+        next_term = node.next_term
+        last = node
+        for newnode in newnodes:
+            newnode.parent = self
+            newnode.left = last
+            newnode.prev_term = last
+            newnode.magic_parent = node.magic_parent
+            last.right = newnode
+            last.next_term = newnode
+            newnode.save_ns()
+            last = newnode
+        node.save_ns()
+        last.right = right
+        if right:
+            right.left = last
+            right.save_ns()
+        last.next_term = next_term
+        next_term.prev_term = last
+        next_term.save_ns()
+        next_term.mark_version()
+        newnodes[0].mark_changed()
 
     def right_sibling(self):
         return self.right
@@ -435,24 +815,273 @@ class Node(object):
 import string
 lowercase = set(list(string.ascii_lowercase))
 uppercase = set(list(string.ascii_uppercase))
+WIDE_NODE = 16 # nodes with more children cache where each child starts
 digits = set(list(string.digits))
 
 class TextNode(Node):
-    __slots__ = ["log", "version", "position", "changed", "deleted", "image", "image_src", "plain_mode", "alternate", "lookahead", "lookup", "parent_lbox", "magic_backpointer", "indent"]
+    __slots__ = ["log", "history", "version", "position", "changed", "deleted", "_image", "image_src", "plain_mode", "_alternate", "production", "pending_alternate", "lookahead", "lookup", "parent_lbox", "magic_backpointer", "indent", "first_term", "height", "chain", "textlength", "newlines", "images", "starts", "isolated"]
     def __init__(self, symbol, state=-1, children=[], pos=-1, lookahead=0):
         Node.__init__(self, symbol, state, children)
         self.position = 0
         self.changed = False
         self.deleted = False
-        self.image = None
+        self._image = None
         self.image_src = None
         self.plain_mode = False
-        self.alternate = None
+        self._alternate = None
+        self.production = None # production the alternate is built from
+        self.pending_alternate = False
         self.lookahead = lookahead
         self.lookup = ""
         self.log = {}
+        self.history = None # saved versions of the fields (see save)
         self.version = 0
         self.indent = None
+        self.first_term = None # first terminal of a subtree (set by the parser)
+        self.height = 0 # height of a balanced list node (set by the parser)
+        self.chain = None # symbols of collapsed unit productions (set by the parser)
+        self.textlength = None # text length, newlines and images of a nonterminal's subtree (see text_length)
+        self.newlines = None
+        self.images = None
+        self.starts = None # where the children of a wide node start (see update_text_cache)
+        self.isolated = False # subtree shifted as a whole around an error (see IncParser.inc_parse)
+
+    def get_image(self):
+        return self._image
+
+    def set_image(self, image):
+        changed = (image is None) != (self._image is None)
+        self._image = image
+        if changed:
+            # the image counts of the ancestors are outdated (see image_count)
+            self.invalidate_text()
+
+    image = property(get_image, set_image)
+
+    def get_alternate(self):
+        if self.isolated:
+            # the children no longer match the production the subtree was
+            # parsed with, so there is no valid AST for it
+            return None
+        if self.pending_alternate:
+            self.build_pending_alternates()
+        return self._alternate
+
+    def build_pending_alternates(self):
+        # building an alternate accesses the alternates of the children, so
+        # build the pending ones bottom-up first. Otherwise long left
+        # recursive lists would exceed the recursion limit
+        order = []
+        todo = [self]
+        while todo:
+            node = todo.pop()
+            order.append(node)
+            for c in node.children:
+                if c.pending_alternate:
+                    todo.append(c)
+        for node in reversed(order):
+            if node.pending_alternate:
+                node.pending_alternate = False
+                node._alternate = node.build_alternate(node.production)
+
+    def set_alternate(self, alternate):
+        self._alternate = alternate
+        self.production = None
+        self.pending_alternate = False
+
+    alternate = property(get_alternate, set_alternate)
+
+    def defer_alternate(self, production):
+        """Sets the production from which the alternate (AST) of this node is
+        built the first time it is accessed."""
+        self._alternate = None
+        self.production = production
+        self.pending_alternate = True
+
+    def build_alternate(self, production):
+        annotation = production.annotation
+        if self.height > 0:
+            # balanced list node (see IncParser.join_sequence)
+            if getattr(annotation, "interpret", None):
+                # the alternate of a list is the list of its elements' alternates
+                from grammar_parser.bootstrap import ListNode
+                parts = []
+                for c in self.children:
+                    if c.symbol == self.symbol:
+                        parts.append(c.alternate)
+                    elif c.alternate:
+                        parts.append(ListNode(self.symbol.name, [c.alternate]))
+                    else:
+                        parts.append(ListNode(self.symbol.name, [c]))
+                return ListNode(self.symbol.name, None, tuple(parts))
+            alternate = TextNode(self.symbol.copy(), self.state, [])
+            alternate.children = list(self.children)
+            return alternate
+        if getattr(annotation, "interpret", None):
+            # eco grammar annotations
+            if not self.chain:
+                return annotation.interpret(self)
+            # collapsed unit productions A ::= B {#0}: interpret the
+            # annotation on a node of B, which is also the alternate if the
+            # annotation doesn't yield one
+            node = TextNode(self.chain[-1].copy(), self.state, [])
+            node.children = list(self.children)
+            alternate = annotation.interpret(node)
+            if alternate is None:
+                return node
+            return alternate
+        # johnstone annotations
+        return self.build_folded_alternate(production)
+
+    def build_folded_alternate(self, production):
+        # add alternate (folded) versions for nodes to the tree
+        alternate = TextNode(self.symbol.__class__(self.symbol.name), self.state, [])
+        alternate.children = []
+        teared = []
+        for i in range(len(self.children)):
+            if production.inserts.has_key(i):
+                # insert teared nodes at right position
+                value = production.inserts[i]
+                for t in teared:
+                    if t.symbol.name == value.name:
+                        alternate.children.append(t)
+            c = self.children[i]
+            if c.symbol.folding == "^^^":
+                c.symbol.folding = None
+                teared.append(c)
+                continue
+            elif c.symbol.folding == "^^":
+                while c.alternate is not None:
+                    c = c.alternate
+                alternate.symbol = c.symbol
+                for child in c.children:
+                    alternate.children.append(child)
+            elif c.symbol.folding == "^":
+                while c.alternate is not None:
+                    c = c.alternate
+                for child in c.children:
+                    alternate.children.append(child)
+            else:
+                alternate.children.append(c)
+        return alternate
+
+    def text_length(self):
+        """Returns the length of the text of this node's subtree. The lengths
+        of nonterminals are cached until a node below them changes."""
+        if isinstance(self.symbol, Nonterminal):
+            if self.textlength is None:
+                self.update_text_cache()
+            return self.textlength
+        if isinstance(self.symbol, IndentationTerminal):
+            return 0
+        if isinstance(self.symbol, MagicTerminal):
+            return self.symbol.ast.text_length()
+        return len(self.symbol.name)
+
+    def newline_count(self):
+        """Returns the number of newlines in the text of this node's subtree."""
+        if isinstance(self.symbol, Nonterminal):
+            if self.textlength is None:
+                self.update_text_cache()
+            return self.newlines
+        if isinstance(self.symbol, IndentationTerminal):
+            return 0
+        if isinstance(self.symbol, MagicTerminal):
+            return self.symbol.ast.newline_count()
+        return self.symbol.name.count("\r")
+
+    def image_count(self):
+        """Returns the number of nodes in this node's subtree that are
+        displayed as images."""
+        if isinstance(self.symbol, Nonterminal):
+            if self.textlength is None:
+                self.update_text_cache()
+            return self.images
+        if isinstance(self.symbol, MagicTerminal):
+            return self.symbol.ast.image_count()
+        if self._image is not None:
+            return 1
+        return 0
+
+    def update_text_cache(self):
+        # update all outdated nonterminals below this node bottom-up, so
+        # long left recursive lists don't exceed the recursion limit
+        order = []
+        todo = [self]
+        while todo:
+            node = todo.pop()
+            order.append(node)
+            for c in node.children:
+                if c.children and c.textlength is None:
+                    todo.append(c)
+        for node in reversed(order):
+            length = 0
+            newlines = 0
+            images = 0
+            children = node.children
+            if len(children) > WIDE_NODE:
+                # wide nodes, e.g. a root whose terminals were flattened by a
+                # failed parse, also store the text length and newlines before
+                # each child, so offsets can be looked up without walking all
+                # siblings (see get_prefix)
+                index = {}
+                lengths = []
+                lines = []
+                for i, c in enumerate(children):
+                    index[id(c)] = i
+                    lengths.append(length)
+                    lines.append(newlines)
+                    length += c.text_length()
+                    newlines += c.newline_count()
+                    images += c.image_count()
+                node.starts = (index, lengths, lines)
+            else:
+                for c in children:
+                    length += c.text_length()
+                    newlines += c.newline_count()
+                    images += c.image_count()
+                node.starts = None
+            node.textlength = length
+            node.newlines = newlines
+            node.images = images
+
+    def get_prefix(self, child):
+        """Returns the text length and the number of newlines of the children
+        before the given child. This is a lookup for wide nodes and otherwise
+        walks at most WIDE_NODE siblings."""
+        if self.textlength is None:
+            self.update_text_cache()
+        if self.starts is not None:
+            index, lengths, lines = self.starts
+            i = index[id(child)]
+            return lengths[i], lines[i]
+        length = 0
+        newlines = 0
+        sibling = child.left
+        while sibling is not None:
+            length += sibling.text_length()
+            newlines += sibling.newline_count()
+            sibling = sibling.left
+        return length, newlines
+
+    def invalidate_text(self):
+        """Marks the cached text lengths of this node and its ancestors as
+        outdated. If a node's length is outdated, so are its ancestors'."""
+        node = self
+        if not isinstance(node.symbol, Nonterminal):
+            node = node.get_parent()
+        while node is not None:
+            if isinstance(node.symbol, Nonterminal):
+                if node.textlength is None:
+                    # The ancestors are outdated already: update_text_cache
+                    # only caches a node together with its whole subtree, and
+                    # lengths are only reset through this method or along
+                    # with all ancestors (see IncParser.do_undo). Nodes that
+                    # are already in a tree must be invalidated before
+                    # set_children resets their own length.
+                    break
+                node.textlength = None
+            node = node.get_parent()
 
     def get_magicterminal(self):
         try:
@@ -502,17 +1131,30 @@ class TextNode(Node):
         self.symbol = _cls(text)
         self.mark_version()
 
-    def save(self, version):
-        Node.save(self, version)
-        self.log[("symbol.name", version)] = self.symbol.name
+    def get_saved_fields(self):
+        fields = Node.get_saved_fields(self)
+        fields.append(("symbol.name", self.symbol.name))
+        # nonterminals are reused by the parser if their children stay the
+        # same (see IncParser.create_node), so their flags have to be
+        # restored, too
+        fields.append(("changed", self.changed))
+        fields.append(("state", self.state))
+        return fields
 
     def load(self, version):
         Node.load(self, version)
+        if self.history is not None and self.history.find(version) != -1:
+            self.changed = self.history.get("changed", version)
+            self.state = self.history.get("state", version)
+        self.invalidate_text()
+        if self.production is not None:
+            # rebuild the alternate from the children of the loaded version
+            self.defer_alternate(self.production)
         if not isinstance(self.symbol, Terminal):
             return
         text = self.get_text(version)
         if text:
-            self.symbol.name = text
+            self.symbol.set_name(text)
         else:
             # remove ?
             #self.parent.remove_child(self)
@@ -525,14 +1167,9 @@ class TextNode(Node):
         return self.log.has_key(("ns", version))
 
     def get_text(self, version):
-        while True:
-            try:
-                return self.log[("symbol.name", version)]
-            except KeyError:
-                version -= 1
-                if version == -1:
-                    return None
-                continue
+        if self.history is None:
+            return None
+        return self.history.get("symbol.name", version)
 
     def insert(self, char, pos):
         l = list(self.symbol.name)
@@ -574,6 +1211,12 @@ class SpecialTextNode(TextNode):
     def backspace(self, pos):
         return
 
+    def text_length(self):
+        return 0
+
+    def newline_count(self):
+        return 0
+
 class BOS(SpecialTextNode):
     pass
 
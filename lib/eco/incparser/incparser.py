@@ -28,7 +28,7 @@ except:
 
 import time, os
 
-from grammar_parser.gparser import Parser, Nonterminal, Terminal,MagicTerminal, Epsilon, IndentationTerminal, AnySymbol
+from grammar_parser.gparser import Parser, Nonterminal, Terminal,MagicTerminal, Epsilon, IndentationTerminal, AnySymbol, intern_symbol
 from syntaxtable import SyntaxTable, FinishSymbol, Reduce, Goto, Accept, Shift
 from stategraph import StateGraph
 from constants import LR0, LR1, LALR
@@ -86,9 +86,12 @@ class IncParser(object):
             self.syntaxtable.build(self.graph)
 
         self.stack = []
+        self.states = []
         self.ast_stack = []
         self.all_changes = []
         self.undo = []
+        self.undo_changed = []
+        self.undo_reused = []
         self.last_shift_state = 0
         self.validating = False
         self.last_status = False
@@ -97,6 +100,13 @@ class IncParser(object):
         self.anycount = set()
         self.status_by_version = {}
         self.errornode_by_version = {}
+        self.isolated = set()
+        self.isolated_error = None # subtree that contains the error (see inc_parse)
+        self.isolated_by_version = {}
+        self.isolation_limit = 2 # number of subtrees tried to isolate an error (see inc_parse)
+        self.batch = False
+        self.sequences = {}
+        self.unit_rules = set()
 
         self.comment_tokens = []
 
@@ -116,6 +126,10 @@ class IncParser(object):
                 self.syntaxtable = pickle.load(f)
             except IOError:
                 pass
+            if self.syntaxtable is not None and not hasattr(self.syntaxtable, "expected"):
+                # pickled by an older version of Eco, which didn't store the
+                # expected symbols of the states
+                self.syntaxtable = None
         if self.syntaxtable is None:
             self.graph = StateGraph(startsymbol, rules, lr_type)
             self.graph.build()
@@ -123,6 +137,8 @@ class IncParser(object):
             self.syntaxtable.build(self.graph, precedences)
             if pickle_id:
                 pickle.dump(self.syntaxtable, open(filename, "w"))
+        elif not self.syntaxtable.is_compiled():
+            self.syntaxtable.compile()
 
         self.whitespaces = whitespaces
         if not rules:
@@ -148,23 +164,186 @@ class IncParser(object):
     def reparse(self):
         self.inc_parse([], True)
 
+    def set_balanced_sequences(self, enabled):
+        """Enables or disables balanced list nodes. If enabled, the nodes of
+        plain list rules (A ::= A B | B, see SyntaxTable.get_sequences) aren't
+        built as left-recursive chains but as balanced trees, whose depth only
+        grows logarithmically with the number of elements. A list node then
+        either has a single element as its child (A ::= B) or two children,
+        each of which is an element or again a list node. Disabled by default,
+        since consumers of the parse tree that walk such lists by position
+        rely on the left-recursive shape (see EcoFile.balance_lists)."""
+        if enabled:
+            self.sequences = self.syntaxtable.get_sequences()
+        else:
+            self.sequences = {}
+
+    def set_collapsed_chains(self, enabled):
+        """Enables or disables collapsing of unit production chains. If
+        enabled, reducing a unit production A ::= B (see
+        SyntaxTable.get_unit_rules) doesn't add a parent node for A to the node
+        of B, but turns the latter into a node for A that records B in its
+        chain. Chains like test -> or_test -> ... -> atom are then stored as a
+        single node. The AST (alternates) stays the same."""
+        if enabled:
+            self.unit_rules = self.syntaxtable.get_unit_rules()
+        else:
+            self.unit_rules = set()
+
     def inc_parse(self, line_indents=[], reparse=False):
-        logging.debug("============ NEW INCREMENTAL PARSE ================= ")
+        if self.inc_parse_once(reparse):
+            self.set_isolated_error(None)
+            return True
+        # Isolate the error: reparse the input treating the (previously valid)
+        # subtree containing the error as a whole. That way the rest of the
+        # tree is still updated and can be reused by the following parses.
+        error_node = self.error_node
+        for node in self.get_isolation_candidates(error_node):
+            self.isolated = set([node])
+            if self.inc_parse_once(reparse):
+                logging.debug("Isolated error %s in %s", error_node, node)
+                # the subtree was shifted with its old production, so mark
+                # it as erroneous for the consumers of the tree
+                self.set_isolated_error(node)
+                # the new parents of the isolated subtree need to be revisited
+                # by the next parse, or the error would go unnoticed
+                parent = node.parent
+                while parent is not None:
+                    parent.changed = True
+                    parent = parent.parent
+                break
+        self.isolated = set()
+        self.error_node = error_node
+        self.last_status = False
+        return False
+
+    def set_isolated_error(self, node):
+        """Marks `node` as the subtree containing the current error, which
+        has no valid AST (see TextNode.get_alternate)."""
+        if self.isolated_error is not None:
+            self.isolated_error.isolated = False
+        if node is not None:
+            node.isolated = True
+        self.isolated_error = node
+
+    def in_isolated_error(self, node):
+        """Returns True if `node` is part of the subtree marked by
+        set_isolated_error."""
+        if self.isolated_error is None:
+            return False
+        while node is not None:
+            if node is self.isolated_error:
+                return True
+            node = node.parent
+        return False
+
+    def get_isolation_candidates(self, error_node):
+        """Returns the changed ancestors of the node where an error occured,
+        starting with the smallest. The root and its direct children (the whole
+        program) are excluded. Every candidate costs another parse of the
+        whole input, so only the smallest `isolation_limit` ones are
+        returned: if they can't be shifted in place of the error, larger
+        subtrees rarely can, and the next edit is parsed as usual anyway."""
+        candidates = []
+        if error_node is None:
+            return candidates
+        if isinstance(error_node, EOS):
+            error_node = error_node.prev_term
+        node = error_node.parent
+        while node is not None and node.parent is not None and node.parent.parent is not None:
+            if len(candidates) == self.isolation_limit:
+                break
+            if node.changed:
+                candidates.append(node)
+            node = node.parent
+        return candidates
+
+    def batch_parse(self):
+        """Parses the whole input from scratch, e.g. after importing or loading
+        a file. All terminals are put directly below the root and then parsed
+        in a single pass without the incremental machinery (breakdowns,
+        lookahead popping, undo logging). The resulting tree is the same as the
+        one built by inc_parse. If the input contains an error, the terminals
+        are left directly below the root."""
+        logging.debug("============ NEW BATCH PARSE ================= ")
+        root = self.previous_version.parent
+        self.flatten(root)
+        self.set_isolated_error(None)
+        bos = self.init_parse()
+        # the parser moves the terminals into new nodes, which changes their
+        # sibling links. Once the root's children have been detached (e.g. by
+        # inserting indentation tokens) they can't be rebuilt from them
+        eos = root.children[-1]
+        syntaxtable = self.syntaxtable
+        self.batch = True
+        try:
+            la = bos.right
+            while True:
+                if not isinstance(la.symbol, FinishSymbol) and self.process_any(la):
+                    la = la.right
+                    continue
+                element = syntaxtable.lookup_id(self.current_state, self.get_lookup(la))
+                if isinstance(element, Shift):
+                    self.shift(la, element)
+                    # la is still a child of the root, so its right sibling
+                    # is the next token, including indentation tokens that
+                    # were inserted while shifting it
+                    la = la.right
+                elif isinstance(element, Reduce):
+                    self.reduce(element)
+                elif isinstance(element, Accept):
+                    root.invalidate_text()
+                    root.set_children([bos, self.stack[1], eos])
+                    self.last_status = True
+                    return True
+                else:
+                    break
+        finally:
+            self.batch = False
+        self.flatten(root)
+        self.error_node = la
+        self.last_status = False
+        return False
+
+    def flatten(self, root):
+        """Makes all terminals of the tree direct children of its root."""
+        bos = root.children[0]
+        terminals = [bos]
+        flat = True
+        node = bos.next_term
+        while not isinstance(node, EOS):
+            if node.parent is not root:
+                flat = False
+            terminals.append(node)
+            node = node.next_term
+        terminals.append(node)
+        if not flat or len(terminals) != len(root.children):
+            root.invalidate_text()
+            root.set_children(terminals)
+
+    def init_parse(self):
+        """Resets the parser's stacks and fixes the indentation tokens at the
+        beginning and the end of the input. Returns BOS."""
         self.validating = False
         self.error_node = None
         self.stack = []
         self.undo = []
+        self.undo_changed = []
+        self.undo_reused = []
+        from treemanager import TreeManager
+        self.undo_ns = ("ns", TreeManager.version)
         self.current_state = 0
         self.stack.append(Node(FinishSymbol(), 0, []))
         self.stack[0].indent = [0]
+        # parse states are kept on a separate stack (parallel to self.stack)
+        # so reused subtrees don't have to be altered when they are shifted
+        self.states = [0]
         bos = self.previous_version.parent.children[0]
         self.loopcount = 0
         self.anycount = set()
         self.any_newlines = []
         self.last_indent = [0]
 
-        USE_OPT = True
-
         eos = self.previous_version.parent.children[-1]
         d = eos.prev_term
         while isinstance(d.symbol, IndentationTerminal):
@@ -184,11 +363,19 @@ class IncParser(object):
         elif isinstance(bos.next_term.symbol, IndentationTerminal):
             bos.next_term.parent.remove_child(bos.next_term)
 
+        return bos
+
+    def inc_parse_once(self, reparse=False):
+        logging.debug("============ NEW INCREMENTAL PARSE ================= ")
+        bos = self.init_parse()
+
+        USE_OPT = True
+
         la = self.pop_lookahead(bos)
         while(True):
             logging.debug("\x1b[35mProcessing\x1b[0m %s %s %s %s", la, la.changed, id(la), la.indent)
             self.loopcount += 1
-            if isinstance(la.symbol, Terminal) or isinstance(la.symbol, FinishSymbol) or la.symbol == Epsilon():
+            if isinstance(la.symbol, Terminal) or isinstance(la.symbol, FinishSymbol) or la.symbol == intern_symbol(Epsilon):
                 if la.changed:#self.has_changed(la):
                     assert False # with prelexing you should never end up here!
                 else:
@@ -204,34 +391,69 @@ class IncParser(object):
                         la = result
 
             else: # Nonterminal
+                if la in self.isolated:
+                    # shift the subtree containing the error as a whole
+                    goto = self.syntaxtable.lookup_id(self.current_state, self.syntaxtable.get_id(la.symbol))
+                    if goto:
+                        self.stack.append(la)
+                        self.states.append(goto.action)
+                        if la.indent:
+                            self.last_indent = list(la.indent)
+                        self.current_state = goto.action
+                        # a following error must not break down this subtree
+                        self.validating = False
+                        la = self.pop_lookahead(la)
+                        continue
+                    element = self.syntaxtable.lookup_reduction(self.current_state, self.syntaxtable.get_id(la.symbol))
+                    if isinstance(element, Reduce):
+                        self.reduce(element)
+                        continue
+                    self.do_undo(la)
+                    self.last_status = False
+                    return False
                 if la.changed or reparse:
                     #la.changed = False # as all nonterminals that have changed are being rebuild, there is no need to change this flag (this also solves problems with comments)
-                    self.undo.append((la, 'changed', True))
+                    self.undo_changed.append(la)
+                    # the node may have been marked as changed in an earlier
+                    # version (see inc_parse), so make sure it is saved
+                    la.save_ns()
                     la = self.left_breakdown(la)
                 else:
                     if USE_OPT:
-                        goto = self.syntaxtable.lookup(self.current_state, la.symbol)
+                        goto = self.syntaxtable.lookup_id(self.current_state, self.syntaxtable.get_id(la.symbol))
                         if goto: # can we shift this Nonterminal in the current state?
                             logging.debug("OPTShift: %s in state %s -> %s", la.symbol, self.current_state, goto)
                             follow_id = goto.action
                             self.stack.append(la)
+                            self.states.append(follow_id)
                             if la.indent:
                                 self.last_indent = list(la.indent)
-                            la.state = follow_id #XXX this fixed goto error (i should think about storing the states on the stack instead of inside the elements)
                             self.current_state = follow_id
                             logging.debug("USE_OPT: set state to %s", self.current_state)
                             la = self.pop_lookahead(la)
                             self.validating = True
                             continue
                         else:
-                            #XXX can be made faster by providing more information in syntax tables
-                            first_term = la.find_first_terminal()
-
-                            lookup_symbol = self.get_lookup(first_term)
-                            element = self.syntaxtable.lookup(self.current_state, lookup_symbol)
+                            if self.sequences:
+                                follow = self.shift_sequence(la)
+                                if follow is not None:
+                                    la = follow
+                                    self.validating = True
+                                    continue
+                            element = self.syntaxtable.lookup_reduction(self.current_state, self.syntaxtable.get_id(la.symbol))
+                            if element is None:
+                                # the reduction depends on the first terminal of the subtree
+                                first_term = la.first_term
+                                if first_term is None:
+                                    first_term = la.find_first_terminal()
+                                lookup_symbol = self.get_lookup(first_term)
+                                element = self.syntaxtable.lookup_id(self.current_state, lookup_symbol)
                             if isinstance(element, Reduce):
                                 self.reduce(element)
                             else:
+                                # the children of the unchanged node are moved
+                                # into new subtrees, so it needs to be saved
+                                la.save_ns()
                                 la = self.left_breakdown(la)
                     else:
                     # PARSER WITHOUT OPTIMISATION
@@ -244,7 +466,7 @@ class IncParser(object):
                         if self.shiftable(la):
                             logging.debug("\x1b[37mis shiftable\x1b[0m")
                             self.stack.append(la)
-                            self.current_state = la.state
+                            self.states.append(element.action)
                             self.right_breakdown()
                             la = self.pop_lookahead(la)
                         else:
@@ -289,7 +511,7 @@ class IncParser(object):
                     last = ne
                     continue
                 else:
-                    ne.symbol.name = e.symbol.name
+                    ne.symbol.set_name(e.symbol.name)
                     ne.mark_changed()
                     continue
             except StopIteration:
@@ -305,12 +527,10 @@ class IncParser(object):
                 break
 
     def parse_anysymbol(self):
-        symbol = AnySymbol()
-        result = self.syntaxtable.lookup(self.current_state, symbol)
-        if not result:
-            symbol = AnySymbol("@ncr")
-            result = self.syntaxtable.lookup(self.current_state, symbol)
-        return result, symbol
+        # ANYSYMBOL only appearing as lookahead of a reduction is handled by
+        # the next terminal, so only shifts are precomputed (see
+        # SyntaxTable.compile)
+        return self.syntaxtable.lookup_any(self.current_state)
 
     def parse_terminal(self, la, lookup_symbol):
         # try parsing ANYSYMBOL
@@ -319,13 +539,15 @@ class IncParser(object):
             if self.process_any(la):
                 return self.pop_lookahead(la)
 
-        element = self.syntaxtable.lookup(self.current_state, lookup_symbol)
-        logging.debug("\x1b[34mparse_terminal\x1b[0m: %s in %s -> %s", lookup_symbol, self.current_state, element)
+        element = self.syntaxtable.lookup_id(self.current_state, lookup_symbol)
+        logging.debug("\x1b[34mparse_terminal\x1b[0m: %s in %s -> %s", la, self.current_state, element)
         if isinstance(element, Accept):
             #XXX change parse so that stack is [bos, startsymbol, eos]
             bos = self.previous_version.parent.children[0]
-            eos = self.previous_version.parent.children[-1]
-            self.previous_version.parent.set_children([bos, self.stack[1], eos])
+            # la is eos. The root's children can't be used to find it if
+            # they have been detached while parsing (see Node.detach_children)
+            self.previous_version.parent.invalidate_text()
+            self.previous_version.parent.set_children([bos, self.stack[1], la])
             logging.debug("loopcount: %s", self.loopcount)
             logging.debug ("\x1b[32mAccept\x1b[0m")
             return "Accept"
@@ -424,10 +646,14 @@ class IncParser(object):
             self.update_succeeding_lines(la, ws, newindent)
 
     def update_succeeding_lines(self, la, ws, newindent):
+        if self.batch:
+            # the following lines are parsed (and indented) next anyway
+            return
         # update succeeding lines
-        # XXX this causes a chain reaction iterating over some lines
-        # multiple times. we might only have to do this for the <return>
-        # that has actually changed during the parse
+        # Every logical line remembers its indentation stack in the indent
+        # attribute of its <return> token. Once a line's tokens and stack
+        # are the same as before, the lines after it aren't affected either
+        # and we can stop.
         next_r = la.next_term
         while True:
             if isinstance(next_r, EOS):
@@ -448,6 +674,11 @@ class IncParser(object):
 
             # XXX need to skip unlogical lines (what if don't know if unlogical yet)
 
+            if next_r.indent is None and next_r.parent.changed:
+                # the line has just been lexed (e.g. by a paste) and will be
+                # shifted by this parse, which updates the lines after it
+                break
+
             # if tokens need to be updated, mark as changed, so the parser will go down this tree to update
             next_ws = self.get_whitespace(next_r)
             if next_ws is None:
@@ -456,6 +687,8 @@ class IncParser(object):
             needed, newindent = self.get_indentation_tokens_and_indent(newindent, next_ws)
             if not self.indents_match(next_r, needed) or next_r.indent != newindent:
                 next_r.mark_changed()
+            else:
+                break
             if next_ws < ws:
                 # if newline has smaller whitespace -> mark and break
                 break
@@ -531,19 +764,51 @@ class IncParser(object):
             node.indent = l
 
     def get_lookup(self, la):
+        """Returns the id of the symbol that is used to look up the node in the
+        syntax table (see SyntaxTable.compile)."""
         if la.lookup != "":
-            lookup_symbol = Terminal(la.lookup)
-        else:
-            lookup_symbol = la.symbol
-        if isinstance(lookup_symbol, IndentationTerminal):
+            return self.syntaxtable.terminal_ids.get(la.lookup, -1)
+        if isinstance(la.symbol, IndentationTerminal):
             #XXX hack: change parsing table to accept IndentationTerminals
-            lookup_symbol = Terminal(lookup_symbol.name)
-        return lookup_symbol
+            return self.syntaxtable.terminal_ids.get(la.symbol.name, -1)
+        return self.syntaxtable.get_id(la.symbol)
 
     def do_undo(self, la):
+        # rollback the links of all nodes that have been moved into new
+        # subtrees during this parse (see reduce)
+        undo_ns = self.undo_ns
+        parents = []
         while len(self.undo) > 0:
-            node, attribute, value = self.undo.pop(-1)
-            setattr(node, attribute, value)
+            node, parent, left, right, had_ns = self.undo.pop(-1)
+            node.parent = parent
+            node.left = left
+            node.right = right
+            if not had_ns:
+                node.log.pop(undo_ns, None)
+            if parent is not None:
+                parents.append(parent)
+        # the list of children of a detached parent may have been rebuilt from
+        # the links of this parse (see Node.attach_children), so drop it and
+        # let it be rebuilt from the restored links. The text lengths of the
+        # parents and their ancestors may have been cached from those lists,
+        # too, so they can't rely on the early stop of invalidate_text
+        seen = set()
+        for parent in parents:
+            parent.detach_children()
+            node = parent
+            while node is not None and id(node) not in seen:
+                seen.add(id(node))
+                node.textlength = None
+                node = node.get_parent()
+        while len(self.undo_reused) > 0:
+            node, state, changed, first_term, indent = self.undo_reused.pop(-1)
+            node.state = state
+            node.changed = changed
+            node.first_term = first_term
+            node.indent = indent
+        for node in self.undo_changed:
+            node.changed = True
+        self.undo_changed = []
         self.error_node = la
         logging.debug ("\x1b[31mError\x1b[0m: %s %s %s", la, la.prev_term, la.next_term)
         logging.debug("loopcount: %s", self.loopcount)
@@ -558,6 +823,7 @@ class IncParser(object):
         i = 0
         while i < element.amount():
             c = self.stack.pop()
+            self.states.pop()
             # apply folding information from grammar to tree nodes
             fold = element.action.right[element.amount()-i-1].folding
             c.symbol.folding = fold
@@ -566,72 +832,275 @@ class IncParser(object):
                 # if this node is part of any, don't count it towards reduce elements
                 i += 1
 
-        logging.debug("   Element on stack: %s(%s)", self.stack[-1].symbol, self.stack[-1].state)
-        self.current_state = self.stack[-1].state #XXX don't store on nodes, but on stack
+        logging.debug("   Element on stack: %s(%s)", self.stack[-1].symbol, self.states[-1])
+        self.current_state = self.states[-1]
         logging.debug("   Reduce: set state to %s (%s)", self.current_state, self.stack[-1].symbol)
 
-        goto = self.syntaxtable.lookup(self.current_state, element.action.left)
+        goto = self.syntaxtable.lookup_id(self.current_state, element.left_id)
         if goto is None:
             raise Exception("Reduction error on %s in state %s: goto is None" % (element, self.current_state))
         assert goto != None
 
-        # save childrens parents state
-        for c in children:
-            self.undo.append((c, 'parent', c.parent))
-            self.undo.append((c, 'left', c.left))
-            self.undo.append((c, 'right', c.right))
-            self.undo.append((c, 'log', c.log.copy()))
-
-        new_node = Node(element.action.left.copy(), goto.action, children)
-        self.set_total_indent(new_node)
+        sequence = self.sequences.get(element.left_id)
+        if sequence is not None and len(children) == 2 and children[0] not in self.isolated:
+            # A ::= A B: add the element to the balanced list (unless the list
+            # is a subtree containing an isolated error, see inc_parse)
+            new_node = self.concat_sequence(children[0], children[1], sequence, goto.action)
+        elif element.action in self.unit_rules and self.is_collapsible(children):
+            new_node = self.collapse_chain(element.action, goto.action, children[0])
+        else:
+            new_node = self.create_node(element.action, goto.action, children)
         logging.debug("   Add %s to stack and goto state %s", new_node.symbol, new_node.state)
         self.stack.append(new_node)
-        self.current_state = new_node.state # = goto.action
+        self.states.append(goto.action)
+        self.current_state = goto.action
         logging.debug("Reduce: set state to %s (%s)", self.current_state, new_node.symbol)
-        if getattr(element.action.annotation, "interpret", None):
-            # eco grammar annotations
-            self.interpret_annotation(new_node, element.action)
+
+    def create_node(self, production, state, children):
+        """Creates the node for the given production and children. If the
+        children are still exactly the children of a node from the previous
+        parse tree (e.g. one that has been broken down because it changed),
+        that node is reused instead."""
+        if not self.batch:
+            new_node = self.get_previous_parent(production, children)
+            if new_node is not None:
+                # the children's links stay the same. The node's fields are
+                # saved with the current version (see TextNode.load), and
+                # restored if this parse fails
+                new_node.save_ns()
+                self.undo_reused.append((new_node, new_node.state, new_node.changed, new_node.first_term, new_node.indent))
+                new_node.state = state
+                new_node.changed = False
+                new_node.first_term = self.get_first_term(children)
+                self.set_total_indent(new_node)
+                self.add_alternate(new_node, production)
+                return new_node
+
+            # save childrens parents state. Creating the new node only changes
+            # the children's links and adds a node-save entry to their logs for
+            # the current version, so that is all we need to remember
+            undo_ns = self.undo_ns
+            for c in children:
+                self.undo.append((c, c.parent, c.left, c.right, undo_ns in c.log))
+
+        new_node = Node(production.left.copy(), state, children)
+        new_node.first_term = self.get_first_term(children)
+        self.set_total_indent(new_node)
+        self.add_alternate(new_node, production)
+        return new_node
+
+    def add_alternate(self, node, production):
+        # the alternate is only built once it is accessed, e.g. by the name
+        # binding analysis
+        node.defer_alternate(production)
+
+    def get_previous_parent(self, production, children):
+        """Returns the node whose children are exactly the given children, if
+        it has been built for the same nonterminal. The children are compared
+        through their sibling links, so the list of children of a detached
+        parent (see Node.detach_children) doesn't need to be rebuilt."""
+        if not children:
+            return None
+        parent = children[0].parent
+        if parent is None or parent.symbol != production.left or parent.chain:
+            return None
+        last = None
+        for c in children:
+            if c.parent is not parent or c.left is not last:
+                return None
+            last = c
+        if last.right is not None:
+            return None
+        return parent
+
+    def is_collapsible(self, children):
+        if len(children) != 1:
+            return False
+        child = children[0]
+        if not isinstance(child.symbol, Nonterminal):
+            return False
+        if not child.pending_alternate and child.alternate is None:
+            return False
+        if child in self.isolated:
+            return False
+        if self.sequences and self.syntaxtable.get_id(child.symbol) in self.sequences:
+            # list nodes need to keep their structure
+            return False
+        return True
+
+    def collapse_chain(self, production, state, child):
+        """Reduces the unit production A ::= B by turning the node of B into
+        a node for A, which records B in its chain. If the node of B is part of
+        a previous version, a new node with the same children is created
+        instead, so the old version can still be restored."""
+        if getattr(production.annotation, "interpret", None):
+            # A ::= B {#0}: A has the alternate of B
+            alternate = None
         else:
-            # johnstone annotations
-            self.add_alternate_version(new_node, element.action)
-
-    def interpret_annotation(self, node, production):
-        annotation = production.annotation
-        if annotation:
-            astnode = annotation.interpret(node)
-            node.alternate = astnode
-
-    def add_alternate_version(self, node, production):
-        # add alternate (folded) versions for nodes to the tree
-        alternate = TextNode(node.symbol.__class__(node.symbol.name), node.state, [])
-        alternate.children = []
-        teared = []
-        for i in range(len(node.children)):
-            if production.inserts.has_key(i):
-                # insert teared nodes at right position
-                value = production.inserts[i]
-                for t in teared:
-                    if t.symbol.name == value.name:
-                        alternate.children.append(t)
-            c = node.children[i]
-            if c.symbol.folding == "^^^":
-                c.symbol.folding = None
-                teared.append(c)
-                continue
-            elif c.symbol.folding == "^^":
-                while c.alternate is not None:
-                    c = c.alternate
+            # A ::= B^ or A ::= B^^ (see TextNode.build_folded_alternate)
+            c = child
+            while c.alternate is not None:
+                c = c.alternate
+            alternate = TextNode(production.left.__class__(production.left.name), state, [])
+            if production.right[0].folding == "^^":
                 alternate.symbol = c.symbol
-                for child in c.children:
-                    alternate.children.append(child)
-            elif c.symbol.folding == "^":
-                while c.alternate is not None:
-                    c = c.alternate
-                for child in c.children:
-                    alternate.children.append(child)
+            alternate.children = list(c.children)
+        chain = (child.symbol,)
+        if child.chain:
+            chain += child.chain
+        if child.log:
+            children = list(self.dismantle(child))
+            if not self.batch:
+                undo_ns = self.undo_ns
+                for c in children:
+                    self.undo.append((c, c.parent, c.left, c.right, undo_ns in c.log))
+            node = Node(production.left.copy(), state, children)
+            node.first_term = child.first_term
+            self.set_total_indent(node)
+        else:
+            # the node has been created by this parse and isn't referenced by
+            # any version yet
+            node = child
+            node.symbol = production.left.copy()
+            node.state = state
+        node.chain = chain
+        if alternate is not None:
+            node.alternate = alternate
+        elif node is not child:
+            if child.pending_alternate:
+                node.defer_alternate(child.production)
             else:
-                alternate.children.append(c)
-        node.alternate = alternate
+                node.alternate = child.alternate
+        return node
+
+    def get_first_term(self, children):
+        """Returns the first terminal within the given children, or None if
+        it isn't known (e.g. the children are empty)."""
+        for c in children:
+            if not isinstance(c.symbol, Nonterminal):
+                return c
+            if c.first_term is not None:
+                return c.first_term
+            if c.children:
+                return None
+        return None
+
+    def shift_sequence(self, la):
+        """Appends the (unchanged) list node la to the list on top of the
+        stack, if the current state allows the list to be continued. Returns
+        the next lookahead on success, otherwise None."""
+        sequence = self.sequences.get(self.syntaxtable.get_id(la.symbol))
+        if sequence is None or self.stack[-1].symbol != la.symbol:
+            return None
+        if self.stack[-1] in self.isolated:
+            return None
+        if not self.syntaxtable.lookup_id(self.current_state, self.syntaxtable.get_id(sequence[1])):
+            return None
+        logging.debug("Append %s to list in state %s", la.symbol, self.current_state)
+        follow = self.pop_lookahead(la)
+        if la.indent:
+            self.last_indent = list(la.indent)
+        self.stack[-1] = self.concat_sequence(self.stack[-1], la, sequence, self.current_state)
+        return follow
+
+    def concat_sequence(self, left, right, sequence, state):
+        """Concatenates two parts of a list (elements or list nodes) and
+        returns the resulting list node. Like in an AVL tree, the heights of
+        the children of a list node differ by at most one, which is restored
+        by rotations if necessary."""
+        symbol = sequence[0]
+        left = self.unwrap_sequence(left, symbol)
+        right = self.unwrap_sequence(right, symbol)
+        hl = self.get_height(left, symbol)
+        hr = self.get_height(right, symbol)
+        if hl > hr + 1:
+            return self.concat_right(left, right, sequence, state)
+        if hr > hl + 1:
+            return self.concat_left(left, right, sequence, state)
+        return self.join_sequence(left, right, sequence, state)
+
+    def concat_right(self, left, right, sequence, state):
+        # left is higher than right: add right to left's rightmost subtree
+        symbol = sequence[0]
+        a, b = self.dismantle(left)
+        ha = self.get_height(a, symbol)
+        hb = self.get_height(b, symbol)
+        hr = self.get_height(right, symbol)
+        if hb <= hr + 1:
+            if max(hb, hr) + 1 <= ha + 1:
+                return self.join_sequence(a, self.join_sequence(b, right, sequence, state), sequence, state)
+            # double rotation
+            b1, b2 = self.dismantle(b)
+            return self.join_sequence(self.join_sequence(a, b1, sequence, state),
+                                      self.join_sequence(b2, right, sequence, state), sequence, state)
+        t = self.concat_right(b, right, sequence, state)
+        if t.height <= ha + 1:
+            return self.join_sequence(a, t, sequence, state)
+        # single rotation
+        t1, t2 = t.children
+        return self.join_sequence(self.join_sequence(a, t1, sequence, state), t2, sequence, state)
+
+    def concat_left(self, left, right, sequence, state):
+        # right is higher than left: add left to right's leftmost subtree
+        symbol = sequence[0]
+        a, b = self.dismantle(right)
+        ha = self.get_height(a, symbol)
+        hb = self.get_height(b, symbol)
+        hl = self.get_height(left, symbol)
+        if ha <= hl + 1:
+            if max(ha, hl) + 1 <= hb + 1:
+                return self.join_sequence(self.join_sequence(left, a, sequence, state), b, sequence, state)
+            # double rotation
+            a1, a2 = self.dismantle(a)
+            return self.join_sequence(self.join_sequence(left, a1, sequence, state),
+                                      self.join_sequence(a2, b, sequence, state), sequence, state)
+        t = self.concat_left(left, a, sequence, state)
+        if t.height <= hb + 1:
+            return self.join_sequence(t, b, sequence, state)
+        # single rotation
+        t1, t2 = t.children
+        return self.join_sequence(t1, self.join_sequence(t2, b, sequence, state), sequence, state)
+
+    def split_sequence(self, node, sequence, state):
+        """Splits a list node into the part containing all but the last
+        element (a list node or a single element) and the last element."""
+        left, right = self.dismantle(node)
+        if right.symbol == sequence[0]:
+            prefix, last = self.split_sequence(right, sequence, state)
+            return self.concat_sequence(left, prefix, sequence, state), last
+        return left, right
+
+    def unwrap_sequence(self, node, symbol):
+        # a list with a single element is represented by the element itself
+        if node.symbol == symbol and len(node.children) == 1:
+            return self.dismantle(node)[0]
+        return node
+
+    def dismantle(self, node):
+        # the children of an existing node are moved into new list nodes, so
+        # it needs to be visited when undoing this version
+        node.save_ns()
+        return node.children
+
+    def get_height(self, node, symbol):
+        if node.symbol == symbol:
+            return node.height
+        return 0
+
+    def join_sequence(self, left, right, sequence, state):
+        """Creates a list node with the given parts as children."""
+        symbol = sequence[0]
+        children = [left, right]
+        if not self.batch:
+            undo_ns = self.undo_ns
+            for c in children:
+                self.undo.append((c, c.parent, c.left, c.right, undo_ns in c.log))
+        node = Node(symbol.copy(), state, children)
+        node.height = max(self.get_height(left, symbol), self.get_height(right, symbol)) + 1
+        node.first_term = self.get_first_term(children)
+        self.set_total_indent(node)
+        self.add_alternate(node, sequence[3])
+        return node
 
     def left_breakdown(self, la):
         if len(la.children) > 0:
@@ -641,17 +1110,32 @@ class IncParser(object):
 
     def right_breakdown(self):
         node = self.stack.pop() # optimistically shifted Nonterminal
+        self.states.pop()
         # after the breakdown, we need to properly shift the left over terminal
         # using the (correct) current state from before the optimistic shift of
         # it's parent tree
-        self.current_state = self.stack[-1].state
+        self.current_state = self.states[-1]
         logging.debug("right breakdown(%s): set state to %s", node.symbol.name, self.current_state)
         while(isinstance(node.symbol, Nonterminal)):
-            for c in node.children:
+            node.save_ns()
+            children = node.children
+            sequence = self.sequences.get(self.syntaxtable.get_id(node.symbol))
+            if sequence is not None and len(children) == 2:
+                # the children of a balanced list node can't be shifted as they
+                # are: break the list down into all but its last element
+                # followed by its last element instead
+                goto = self.syntaxtable.lookup_id(self.current_state, self.syntaxtable.get_id(node.symbol))
+                state = goto.action if goto else -1
+                prefix, last = self.split_sequence(node, sequence, state)
+                if prefix.symbol != node.symbol:
+                    prefix = self.create_node(sequence[2], state, [prefix])
+                children = [prefix, last]
+            for c in children:
                 if not self.process_any(c): # in breakdown we also have to take care of ANYSYMBOLs
                     self.shift(c, rb=True)
                 c = c.right
             node = self.stack.pop()
+            self.states.pop()
             # after undoing an optimistic shift (through pop) we need to revert
             # back to the state before the shift (which can be found on the top
             # of the stack after the "pop"
@@ -660,41 +1144,54 @@ class IncParser(object):
                 # FinishSymbol pack onto the stack
                 self.current_state = 0
                 self.stack.append(node)
+                self.states.append(0)
                 return
             else:
-                logging.debug("right breakdown else: set state to %s", self.stack[-1].state)
-                self.current_state = self.stack[-1].state
+                logging.debug("right breakdown else: set state to %s", self.states[-1])
+                self.current_state = self.states[-1]
         if not self.process_any(node):
             self.shift(node, rb=True) # pushes previously popped terminal back on stack
 
     def shift(self, la, element=None, rb=False):
         if not element:
             lookup_symbol = self.get_lookup(la)
-            element = self.syntaxtable.lookup(self.current_state, lookup_symbol)
+            element = self.syntaxtable.lookup_id(self.current_state, lookup_symbol)
         logging.debug("\x1b[32m" + "%sShift(%s)" + "\x1b[0m" + ": %s -> %s", "rb" if rb else "", self.current_state, la, element)
-        la.state = element.action
+        if isinstance(element, Shift):
+            state = element.action
+        else:
+            # breaking down a subtree that doesn't fit into the current state
+            # (e.g. one containing an isolated error): continue in a state
+            # without actions so parsing fails on the next lookup
+            state = self.syntaxtable.error_state
+        # terminals still remember their state, which is used to look up the
+        # symbols for code completion (see TreeManager.getLookaheadList)
+        la.state = state
         self.stack.append(la)
-        self.current_state = la.state
+        self.states.append(state)
+        self.current_state = state
 
         if not la.lookup == "<ws>":
             # last_shift_state is used to predict next symbol
             # whitespace destroys correct behaviour
-            self.last_shift_state = element.action
+            self.last_shift_state = state
 
         if self.indentation_based and not rb:
             return self.parse_whitespace(la)
 
     def process_any(self, la):
-        result, symbol = self.parse_anysymbol()
+        if not self.syntaxtable.has_any:
+            return False
+        result, name = self.parse_anysymbol()
         if result:
             # ANYSYMBOL with finishing symbol
-            r_finish = self.syntaxtable.lookup(result.action, self.get_lookup(la))
+            r_finish = self.syntaxtable.lookup_id(result.action, self.get_lookup(la))
             if isinstance(r_finish, Shift):
                 self.end_any(la, result)
                 return False
             # ANY without finishing symbol
-            elif symbol.name == "@ncr" and (la.lookup == "<return>" or la.symbol == IndentationTerminal("NEWLINE") or isinstance(la, EOS)):
-                self.end_any(la, result, symbol.name)
+            elif name == "@ncr" and (la.lookup == "<return>" or la.symbol == intern_symbol(IndentationTerminal, "NEWLINE") or isinstance(la, EOS)):
+                self.end_any(la, result, name)
                 return False
             else:
                 self.push_any(la)
@@ -704,6 +1201,7 @@ class IncParser(object):
         logging.debug("AnySymbol: push %s" % (la))
         la.state = self.current_state # this node is now part of this comment state (needed to unvalidating)
         self.stack.append(la)
+        self.states.append(self.current_state)
         self.anycount.add(la)
         if la.lookup == "<return>" and self.indentation_based:
             self.any_newlines.append(la)
@@ -750,11 +1248,7 @@ class IncParser(object):
         return AST(root)
 
     def get_next_possible_symbols(self, state_id):
-        l = set()
-        for (state, symbol) in self.syntaxtable.table.keys():
-            if state == state_id:
-                l.add(symbol)
-        return l
+        return set(self.syntaxtable.get_symbols(state_id))
 
     def get_next_symbols_list(self, state = -1):
         if state == -1:
@@ -774,21 +1268,23 @@ class IncParser(object):
         #XXX if state of a symbol is nullable, return next symbol as well
         #XXX if at end of state, find state we came from (reduce, stack) and get next symbols from there
         if state_id != -1:
-            stateset = self.graph.state_sets[state_id]
-            symbols = stateset.get_next_symbols_no_ws()
-            return symbols
+            return self.syntaxtable.get_expected_symbols(state_id)
         return []
 
 
     def reset(self):
         self.stack = []
+        self.states = []
         self.ast_stack = []
         self.all_changes = []
         self.undo = []
+        self.undo_changed = []
+        self.undo_reused = []
         self.last_shift_state = 0
         self.validating = False
         self.last_status = False
         self.error_node = None
+        self.set_isolated_error(None)
         self.previous_version = None
         self.init_ast()
 
@@ -801,7 +1297,22 @@ class IncParser(object):
             self.error_node = self.errornode_by_version[version]
         except KeyError:
             logging.warning("Could not find errornode for version %s", version)
+        # the isolated subtree may be a valid node in other versions
+        self.set_isolated_error(self.isolated_by_version.get(version))
 
     def save_status(self, version):
         self.status_by_version[version] = self.last_status
         self.errornode_by_version[version] = self.error_node
+        self.isolated_by_version[version] = self.isolated_error
+
+    def compact_status(self, version):
+        """Drops the status of all versions older than `version`. Returns the
+        number of dropped entries."""
+        dropped = 0
+        for key in self.status_by_version.keys():
+            if key < version:
+                del self.status_by_version[key]
+                self.errornode_by_version.pop(key, None)
+                self.isolated_by_version.pop(key, None)
+                dropped += 1
+        return dropped
@@ -19,8 +19,10 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 
+from array import array
+
 from production import Production
-from grammar_parser.gparser import Terminal, Nonterminal, Epsilon, AnySymbol
+from grammar_parser.gparser import Terminal, Nonterminal, Epsilon, AnySymbol, MagicTerminal, intern_symbol, intern_name
 from constants import LR0, LR1, LALR
 
 class SyntaxTableElement(object):
@@ -35,6 +37,9 @@ class SyntaxTableElement(object):
         return "%s(%s)" % (self.__class__.__name__, self.action)
 
 class FinishSymbol(object):
+    # XXX hack: may cause errors if grammar consist of same symbol
+    _hash = hash("FinishSymbol123")
+
     def __init__(self):
         self.name = "eos"
 
@@ -42,8 +47,7 @@ class FinishSymbol(object):
         return isinstance(other, FinishSymbol)
 
     def __hash__(self):
-        # XXX hack: may cause errors if grammar consist of same symbol
-        return hash("FinishSymbol123")
+        return self._hash
 
     def __repr__(self):
         return "$"
@@ -61,11 +65,17 @@ class Reduce(SyntaxTableElement):
                 break
 
     def amount(self):
+        try:
+            return self._amount
+        except AttributeError:
+            pass
         if not hasattr(self, 'anysymbol'):
             self.anysymbol = 0
-        if self.action.right == [Epsilon()]:
-            return 0
-        return len(self.action.right) - self.anysymbol
+        if self.action.right == [intern_symbol(Epsilon)]:
+            self._amount = 0
+        else:
+            self._amount = len(self.action.right) - self.anysymbol
+        return self._amount
 
 class Accept(SyntaxTableElement):
     def __init__(self, action=None):
@@ -77,6 +87,22 @@ class SyntaxTable(object):
         self.table = {}
         self.lr_type = lr_type
 
+        # compiled representation of the table (see compile)
+        self.symbols = []
+        self.symbol_ids = {}
+        self.terminal_ids = {}
+        self.actions = [None]
+        self.width = 0
+        self.flat = array("i")
+        self.error_state = 0
+        self.any_actions = array("i")
+        self.has_any = False
+        self.first_ids = {}
+        self.reductions = array("i")
+        self.state_index = array("i", [0])
+        self.state_symbols = array("i")
+        self.expected = []
+
     def build(self, graph, precedences=[]):
         start_production = Production(None, [graph.start_symbol])
         symbols = graph.get_symbols()
@@ -116,6 +142,189 @@ class SyntaxTable(object):
                         self.table[(i, s)] = action
                     else:
                         del self.table[(i,s)]
+        # the symbols expected in a state depend on its LR items, which aren't
+        # part of the table (see get_expected_symbols)
+        self.expected = [list(graph.get_state_set(i).get_next_symbols_no_ws()) for i in range(len(graph.state_sets))]
+        self.compile()
+
+    def compile(self):
+        """Converts the table into a dense integer representation.
+
+        All symbols are numbered and the actions are stored in a flat array
+        which is indexed by `state * width + symbol_id`. An entry of 0 means
+        there is no action, every other entry is an index into self.actions.
+        This allows the parser to do its lookups without creating or hashing
+        symbols."""
+        self.symbols = []
+        self.symbol_ids = {}
+        self.terminal_ids = {}
+        # the table is compiled whenever it is loaded (see __getstate__), so
+        # each entry's symbol is only hashed once here
+        entries = []
+        states = 0
+        for (state, symbol), action in self.table.iteritems():
+            symbol_id = self.symbol_ids.get(symbol)
+            if symbol_id is None:
+                symbol_id = self.symbol_ids[symbol] = len(self.symbols)
+                self.symbols.append(symbol)
+            entries.append((state, symbol_id, action))
+            if state >= states:
+                states = state + 1
+            if action.__class__ is Shift or action.__class__ is Goto:
+                if action.action >= states:
+                    states = action.action + 1
+        # additional state without any actions
+        self.error_state = states
+        states += 1
+        for symbol, symbol_id in self.symbol_ids.items():
+            # the lexer only knows the names of the terminals, so we need an
+            # additional mapping from names to ids
+            if isinstance(symbol, Terminal) and not isinstance(symbol, MagicTerminal):
+                self.terminal_ids[intern_name(symbol.name)] = symbol_id
+
+        self.width = len(self.symbols)
+        self.actions = [None]
+        action_ids = {}
+        self.flat = array("i", [0]) * (states * self.width)
+        for state, symbol_id, action in entries:
+            # identical shift/goto/reduce actions can share a slot
+            cls = action.__class__
+            if cls is Shift or cls is Goto:
+                key = (cls, action.action)
+            elif cls is Reduce:
+                # the productions of the table are shared, so they don't need
+                # to be hashed
+                key = (cls, id(action.action))
+            else:
+                key = id(action)
+            action_id = action_ids.get(key)
+            if action_id is None:
+                action_id = action_ids[key] = len(self.actions)
+                self.actions.append(action)
+                if cls is Reduce:
+                    # the goto of a reduction is looked up by id as well
+                    action.left_id = self.symbol_ids.get(action.action.left, -1)
+            self.flat[state * self.width + symbol_id] = action_id
+
+        # shifts on ANYSYMBOL per state: a positive value is the index of the
+        # action shifting `@`, a negative one the (negated) index of the
+        # action shifting `@ncr`
+        any_id = self.symbol_ids.get(intern_symbol(AnySymbol), -1)
+        ncr_id = self.symbol_ids.get(intern_symbol(AnySymbol, "@ncr"), -1)
+        self.any_actions = array("i", [0]) * states
+        for state in range(states):
+            row = state * self.width
+            if any_id >= 0 and self.flat[row + any_id]:
+                action_id = self.flat[row + any_id]
+                if isinstance(self.actions[action_id], Shift):
+                    self.any_actions[state] = action_id
+            elif ncr_id >= 0 and self.flat[row + ncr_id]:
+                action_id = self.flat[row + ncr_id]
+                if isinstance(self.actions[action_id], Shift):
+                    self.any_actions[state] = -action_id
+        self.has_any = any(self.any_actions)
+
+        # ids of the symbols that have an action in a state, stored for all
+        # states in one array: the symbols of state i can be found between
+        # state_index[i] and state_index[i+1]
+        per_state = [[] for i in range(states)]
+        for state, symbol_id, action in entries:
+            per_state[state].append(symbol_id)
+        self.state_index = array("i", [0])
+        self.state_symbols = array("i")
+        for ids in per_state:
+            ids.sort()
+            self.state_symbols.extend(ids)
+            self.state_index.append(len(self.state_symbols))
+
+        self.compile_first()
+        self.reset_reductions()
+
+    def reset_reductions(self):
+        # reductions on nonterminals are calculated on demand (see
+        # lookup_reduction): -2 = not calculated yet, -1 = depends on the
+        # subtree, 0 = no reduction, otherwise an index into self.actions
+        states = len(self.any_actions)
+        self.reductions = array("i", [-2]) * (states * self.width)
+
+    # fields of the compiled representation (see compile)
+    compiled = ["symbols", "symbol_ids", "terminal_ids", "actions", "width",
+                "flat", "error_state", "any_actions", "has_any", "first_ids",
+                "reductions", "state_index", "state_symbols"]
+
+    def __getstate__(self):
+        # the compiled representation is rebuilt from the table when it is
+        # loaded, which is faster than unpickling it
+        state = self.__dict__.copy()
+        for name in self.compiled:
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.is_compiled():
+            # pickled by an older version of Eco
+            self.reset_reductions()
+
+    def compile_first(self):
+        """Calculates the ids of the terminals each nonterminal can start
+        with. The productions are taken from the reductions in the table.
+        Nullable nonterminals and nonterminals that can start with an
+        ANYSYMBOL get no entry, as the first terminal of their subtrees isn't
+        known from the grammar alone."""
+        productions = set()
+        for action in self.actions:
+            if isinstance(action, Reduce):
+                productions.add(action.action)
+        first = {}
+        nullable = set()
+        changes = True
+        while changes:
+            changes = False
+            for p in productions:
+                first_set = first.setdefault(p.left, set())
+                size = len(first_set)
+                for symbol in p.right:
+                    if isinstance(symbol, Epsilon):
+                        continue
+                    if isinstance(symbol, Nonterminal):
+                        first_set |= first.get(symbol, set())
+                        if symbol in nullable:
+                            continue
+                    else:
+                        first_set.add(symbol)
+                    break
+                else:
+                    if p.left not in nullable:
+                        nullable.add(p.left)
+                        changes = True
+                if len(first_set) != size:
+                    changes = True
+
+        self.first_ids = {}
+        for nonterminal, first_set in first.items():
+            if nonterminal in nullable or nonterminal not in self.symbol_ids:
+                continue
+            ids = []
+            for symbol in first_set:
+                if isinstance(symbol, AnySymbol):
+                    break
+                if isinstance(symbol, Terminal) and not isinstance(symbol, MagicTerminal):
+                    # terminal nodes are looked up by name (see IncParser.get_lookup)
+                    ids.append(self.terminal_ids.get(symbol.name, -1))
+                else:
+                    ids.append(self.symbol_ids.get(symbol, -1))
+            else:
+                self.first_ids[self.symbol_ids[nonterminal]] = tuple(ids)
+
+    def is_compiled(self):
+        # tables pickled by older versions of Eco don't have a compiled
+        # representation yet
+        return hasattr(self, "error_state") and hasattr(self, "any_actions")
+
+    def get_id(self, symbol):
+        """Returns the id of a symbol or -1 if it doesn't appear in the table."""
+        return self.symbol_ids.get(symbol, -1)
 
     def resolve_conflict(self, state, symbol, oldaction, newaction, precedences):
         # input: old_action, lookup_symbol, new_action
@@ -197,7 +406,132 @@ class SyntaxTable(object):
         return None
 
     def lookup(self, state_id, symbol):
-        try:
-            return self.table[(state_id, symbol)]
-        except KeyError:
+        return self.lookup_id(state_id, self.symbol_ids.get(symbol, -1))
+
+    def lookup_id(self, state_id, symbol_id):
+        if symbol_id < 0:
+            return None
+        return self.actions[self.flat[state_id * self.width + symbol_id]]
+
+    def get_symbols(self, state_id):
+        """Returns all symbols that have an action in the given state."""
+        if state_id < 0 or state_id + 1 >= len(self.state_index):
+            return []
+        start = self.state_index[state_id]
+        end = self.state_index[state_id + 1]
+        return [self.symbols[i] for i in self.state_symbols[start:end]]
+
+    def get_expected_symbols(self, state_id):
+        """Returns the symbols that can be shifted in the given state, without
+        whitespace. Like StateSet.get_next_symbols_no_ws these are taken from
+        the state's LR items, skipping the items of the WS productions, so it
+        can be used when the table was loaded from the cache and there is no
+        state graph."""
+        if state_id < 0 or state_id >= len(self.expected):
+            return set()
+        return set(self.expected[state_id])
+
+    def lookup_any(self, state_id):
+        """Returns the shift on ANYSYMBOL in the given state together with the
+        ANYSYMBOL's name (`@` or `@ncr`), or (None, None)."""
+        action_id = self.any_actions[state_id]
+        if action_id > 0:
+            return self.actions[action_id], "@"
+        if action_id < 0:
+            return self.actions[-action_id], "@ncr"
+        return None, None
+
+    def lookup_reduction(self, state_id, symbol_id):
+        """Decides if a subtree of the nonterminal with the given id, which
+        can't be shifted in the given state, causes a reduction. Returns the
+        Reduce action if every terminal the subtree can start with reduces it,
+        False if none of them does, or None if it depends on the actual first
+        terminal of the subtree."""
+        if symbol_id < 0:
             return None
+        index = state_id * self.width + symbol_id
+        action_id = self.reductions[index]
+        if action_id == -2:
+            action_id = self.get_reduction_id(state_id, symbol_id)
+            self.reductions[index] = action_id
+        if action_id == -1:
+            return None
+        if action_id == 0:
+            return False
+        return self.actions[action_id]
+
+    def get_sequences(self):
+        """Finds the nonterminals that describe plain lists, i.e. that only
+        have the two productions A ::= B and A ::= A B (without folding and
+        either without annotations or with the list annotations [#0] and
+        #0 + [#1]). Returns a dictionary mapping the ids of these nonterminals
+        to tuples (A, B, A ::= B, A ::= A B)."""
+        from grammar_parser.bootstrap import LookupExpr, ListExpr, AddExpr
+        productions = {}
+        for element in self.actions:
+            if isinstance(element, Reduce):
+                productions.setdefault(element.action.left, set()).add(element.action)
+        sequences = {}
+        for symbol, rules in productions.items():
+            if len(rules) != 2:
+                continue
+            base, step = sorted(rules, key=lambda p: len(p.right))
+            if len(base.right) != 1 or len(step.right) != 2:
+                continue
+            element = base.right[0]
+            if not isinstance(element, Nonterminal) or element == symbol:
+                continue
+            if step.right != [symbol, element]:
+                continue
+            if [s for s in base.right + step.right if s.folding]:
+                continue
+            if base.annotation is None and step.annotation is None:
+                pass
+            elif not (isinstance(base.annotation, ListExpr) and isinstance(step.annotation, AddExpr)
+                      and base.annotation == ListExpr([LookupExpr(0)])
+                      and step.annotation == AddExpr(LookupExpr(0), ListExpr([LookupExpr(1)]))):
+                continue
+            sequences[self.get_id(symbol)] = (symbol, element, base, step)
+        return sequences
+
+    def get_unit_rules(self):
+        """Finds the unit productions A ::= B (B being a nonterminal) whose
+        node can be merged with the node of B without changing the AST, i.e.
+        productions that are annotated with #0 or fold B (B^ or B^^). Returns
+        the set of these productions."""
+        from grammar_parser.bootstrap import LookupExpr
+        rules = set()
+        for element in self.actions:
+            if not isinstance(element, Reduce):
+                continue
+            production = element.action
+            if len(production.right) != 1 or production.inserts:
+                continue
+            symbol = production.right[0]
+            if not isinstance(symbol, Nonterminal) or symbol.name == "WS":
+                continue
+            annotation = production.annotation
+            if getattr(annotation, "interpret", None):
+                if not (isinstance(annotation, LookupExpr) and annotation == LookupExpr(0)):
+                    continue
+            elif symbol.folding not in ("^", "^^"):
+                continue
+            rules.add(production)
+        return rules
+
+    def get_reduction_id(self, state_id, symbol_id):
+        first_ids = self.first_ids.get(symbol_id)
+        if not first_ids:
+            return -1
+        row = state_id * self.width
+        action_ids = set()
+        for terminal_id in first_ids:
+            action_id = 0
+            if terminal_id >= 0:
+                action_id = self.flat[row + terminal_id]
+                if not isinstance(self.actions[action_id], Reduce):
+                    action_id = 0
+            action_ids.add(action_id)
+            if len(action_ids) > 1:
+                return -1
+        return action_ids.pop()
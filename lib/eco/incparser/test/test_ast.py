@@ -22,7 +22,8 @@
 from incparser.lrparser import LRParser
 from incparser.incparser import IncParser
 from incparser.constants import LR0, LR1, LALR
-from incparser.astree import AST, Node
+from incparser.astree import AST, Node, TextNode, BOS, EOS, History
+from incparser.syntaxtable import FinishSymbol
 from grammar_parser.gparser import Parser, Nonterminal, Terminal, Epsilon
 
 import pytest
@@ -54,6 +55,81 @@ def test_node():
     assert plus.right_sibling() is i2
     assert i2.right_sibling() is None
 
+def test_splice():
+    terminals = [TextNode(Terminal(str(i))) for i in range(4)]
+    bos = BOS(Terminal(""))
+    eos = EOS(FinishSymbol())
+    last = bos
+    for t in terminals + [eos]:
+        last.next_term = t
+        t.prev_term = last
+        last = t
+    parent = TextNode(Nonterminal("T"), 0, [bos] + terminals + [eos])
+
+    parent.remove_child(terminals[0])
+    x = TextNode(Terminal("x"))
+    parent.insert_after_node(terminals[2], x)
+    parent.remove_child(terminals[3])
+    assert parent.is_detached()
+    assert [c.symbol.name for c in parent.children] == ["", "1", "2", "x", "eos"]
+    assert parent.children[3] is x
+    assert not parent.is_detached()
+    assert terminals[2].next_term is x
+    assert x.next_term is eos
+
+def test_history():
+    terminals = [TextNode(Terminal(str(i))) for i in range(20)]
+    for a, b in zip(terminals, terminals[1:]):
+        a.next_term = b
+        b.prev_term = a
+    parent = TextNode(Nonterminal("T"), 0, list(terminals))
+    parent.save(1)
+    for i, t in enumerate(terminals):
+        t.save(1)
+    parent.remove_child(terminals[5])
+    terminals[3].symbol.name = "x"
+    parent.save(3)
+    terminals[3].save(3)
+    parent.insert_after_node(terminals[10], terminals[5])
+    parent.save(4)
+    for i in range(6, 10):
+        parent.remove_child(terminals[i])
+        parent.save(4 + i)
+
+    history = parent.history
+    assert history.versions == [1, 3, 4, 10, 11, 12, 13]
+    # unchanged fields aren't stored again
+    assert history.fields["parent"] == ([1], [None])
+    # only the changed parts of the children are stored
+    assert isinstance(history.children[0], list)
+    assert history.children[1] == (5, 6, [])
+
+    parent.load(2)
+    assert parent.version == 1
+    assert parent.children == terminals
+    parent.load(5)
+    assert parent.version == 4
+    assert parent.children == terminals[:5] + terminals[6:11] + [terminals[5]] + terminals[11:]
+    parent.load(13)
+    assert parent.children == terminals[:5] + [terminals[10], terminals[5]] + terminals[11:]
+    assert terminals[3].get_text(2) == "3"
+    assert terminals[3].get_text(3) == "x"
+    assert terminals[3].get_text(0) is None
+
+    history.truncate(4)
+    assert history.versions == [1, 3, 4]
+    parent.load(13)
+    assert parent.version == 4
+    assert parent.children == terminals[:5] + terminals[6:11] + [terminals[5]] + terminals[11:]
+
+    # version 1 of the versions, the children and the changed flag
+    assert history.compact(3) == 3
+    assert history.versions == [3, 4]
+    assert isinstance(history.children[0], list)
+    parent.load(3)
+    assert parent.version == 3
+    assert parent.children == terminals[:5] + terminals[6:]
+
 def notest_ast():
     lrp = LRParser(grammar)
     lrp.check("1 + 2 * 3")
@@ -19,9 +19,11 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 
+import pickle
+
 from incparser.syntaxtable import SyntaxTable, Goto, Shift, Reduce, Accept, FinishSymbol
 from incparser.stategraph import StateGraph
-from grammar_parser.gparser import Parser, Terminal, Nonterminal, Epsilon
+from grammar_parser.gparser import Parser, Terminal, Nonterminal, Epsilon, AnySymbol
 from incparser.production import Production
 
 grammar = """
@@ -68,3 +70,103 @@ def test_build():
     st.build(graph)
     for key in syntaxtable.keys():
         assert st.table[key] == syntaxtable[key]
+
+def test_compiled_lookup():
+    graph = StateGraph(p.start_symbol, p.rules, 1)
+    graph.build()
+    st = SyntaxTable(1)
+    st.build(graph)
+    for (state, symbol) in syntaxtable.keys():
+        symbol_id = st.get_id(symbol)
+        assert symbol_id >= 0
+        assert st.lookup_id(state, symbol_id) == syntaxtable[(state, symbol)]
+        assert st.lookup(state, symbol) == syntaxtable[(state, symbol)]
+    assert st.terminal_ids["b"] == st.get_id(b)
+    assert st.lookup_id(0, st.get_id(d)) is None
+    assert st.lookup_id(0, -1) is None
+    assert st.lookup(0, Terminal("x")) is None
+    assert st.lookup_id(5, st.get_id(FinishSymbol())).left_id == st.get_id(S)
+
+def test_lookup_reduction():
+    p2 = Parser("""
+        S ::= X Y
+        X ::= "x"
+        Y ::= "y"
+            | "z"
+    """)
+    p2.parse()
+    graph = StateGraph(p2.start_symbol, p2.rules, 1)
+    graph.build()
+    st = SyntaxTable(1)
+    st.build(graph)
+    X = Nonterminal("X")
+    Y = Nonterminal("Y")
+    state = st.lookup(0, Terminal("x")).action
+    reduction = st.lookup_reduction(state, st.get_id(Y))
+    assert isinstance(reduction, Reduce)
+    assert reduction.action == Production(X, [Terminal("x")])
+    assert st.lookup_reduction(0, st.get_id(Y)) is False
+    assert st.lookup_reduction(0, -1) is None
+
+    # the first terminal of a nullable nonterminal isn't known
+    st = SyntaxTable(1)
+    graph = StateGraph(p.start_symbol, p.rules, 1)
+    graph.build()
+    st.build(graph)
+    assert st.get_id(A) not in st.first_ids
+    assert st.lookup_reduction(2, st.get_id(A)) is None
+
+def test_pickle():
+    graph = StateGraph(p.start_symbol, p.rules, 1)
+    graph.build()
+    st = SyntaxTable(1)
+    st.build(graph)
+    state = st.lookup(0, b).action
+    st.lookup_reduction(state, st.get_id(A))
+    assert list(st.reductions) != [-2] * len(st.reductions)
+    state = st.__getstate__()
+    assert "table" in state
+    for name in SyntaxTable.compiled:
+        assert name not in state
+    st = pickle.loads(pickle.dumps(st))
+    assert not st.is_compiled()
+    st.compile()
+    assert list(st.reductions) == [-2] * len(st.reductions)
+    assert len(st.reductions) == len(st.any_actions) * st.width
+    for (state, symbol) in syntaxtable.keys():
+        assert st.lookup(state, symbol) == syntaxtable[(state, symbol)]
+
+def test_state_symbols():
+    graph = StateGraph(p.start_symbol, p.rules, 1)
+    graph.build()
+    st = SyntaxTable(1)
+    st.build(graph)
+    for i in range(len(graph.state_sets)):
+        expected = set([symbol for (state, symbol) in syntaxtable.keys() if state == i])
+        assert set(st.get_symbols(i)) == expected
+    assert st.get_expected_symbols(2) == set([c, A])
+    assert st.get_expected_symbols(4) == set()
+    assert st.get_symbols(-1) == []
+    assert st.get_symbols(len(graph.state_sets)) == []
+
+def test_lookup_any():
+    st = SyntaxTable(1)
+    st.table = {
+        (0, AnySymbol()): Shift(1),
+        (1, Terminal("x")): Shift(2),
+        (2, AnySymbol("@ncr")): Shift(3),
+        (3, FinishSymbol()): Reduce(A_c),
+        (3, AnySymbol()): Reduce(A_c),
+    }
+    st.compile()
+    assert st.has_any
+    assert st.lookup_any(0) == (Shift(1), "@")
+    assert st.lookup_any(1) == (None, None)
+    assert st.lookup_any(2) == (Shift(3), "@ncr")
+    assert st.lookup_any(3) == (None, None)
+
+    graph = StateGraph(p.start_symbol, p.rules, 1)
+    graph.build()
+    st = SyntaxTable(1)
+    st.build(graph)
+    assert not st.has_any
@@ -200,11 +200,8 @@ class NodeEditor(QFrame):
         self.update()
 
     def getScrollSizes(self):
-        total_lines = 0
-        max_width = 0
-        for l in self.lines:
-            total_lines += l.height
-            max_width = max(max_width, l.width)
+        total_lines = self.lines.get_height()
+        max_width = self.lines.get_width()
         max_visible_lines = self.geometry().height() / self.fontht
         self.scroll_height = max(0, total_lines - max_visible_lines)
 
@@ -240,11 +237,8 @@ class NodeEditor(QFrame):
 
         paint.end()
 
-        total_lines = 0
-        max_width = 0
-        for l in self.lines:
-            total_lines += l.height
-            max_width = max(max_width, l.width)
+        total_lines = self.lines.get_height()
+        max_width = self.lines.get_width()
         max_visible_lines = self.geometry().height() / self.fontht
         self.scroll_height = max(0, total_lines - max_visible_lines)
 
@@ -258,13 +252,7 @@ class NodeEditor(QFrame):
     def paintLines(self, paint, startline):
 
         # find internal line corresponding to visual line
-        visual_line = 0
-        internal_line = 0
-        for l in self.tm.lines:
-            if visual_line + l.height > startline:
-                break
-            visual_line += l.height
-            internal_line += 1
+        internal_line, visual_line = self.tm.lines.find_row(startline)
 
         x = 0
         y = visual_line - startline # start drawing outside of viewport to display partial images
@@ -317,7 +305,7 @@ class NodeEditor(QFrame):
 
         self.lines = self.tm.lines
         self.cursor = self.tm.cursor
-        self.lines[line].height = 1 # reset height
+        self.lines.set_height(line, 1) # reset height
         draw_cursor = True
         #l_x = [0]
         while y < max_y:
@@ -366,7 +354,7 @@ class NodeEditor(QFrame):
                         error_node = self.fix_errornode(error_node)
                     continue
                 else:
-                    self.lines[line].width = x / self.fontwt
+                    self.lines.set_width(line, x / self.fontwt)
                     break
 
             # draw language boxes
@@ -400,7 +388,7 @@ class NodeEditor(QFrame):
             dx, dy = editor.paint_node(paint, node, x, y, highlighter)
             x += dx
             #y += dy
-            self.lines[line].height = max(self.lines[line].height, dy)
+            self.lines.set_height(line, max(self.lines[line].height, dy))
 
             # Draw footnotes and add data to heatmap.
             annotes = [annote.annotation for annote in node.get_annotations_with_hint(Heatmap)]
@@ -422,7 +410,7 @@ class NodeEditor(QFrame):
                                  else x - len(footnote) * infofont.fontwt)
                     start_y = self.fontht + ((y + 1) * self.fontht)
                     paint.drawText(QtCore.QPointF(x-dx, start_y), footnote)
-                    self.lines[line].height = max(self.lines[line].height, 2)
+                    self.lines.set_height(line, max(self.lines[line].height, 2))
                     paint.setFont(self.font)
 
             # after we drew a return, update line information
@@ -431,11 +419,11 @@ class NodeEditor(QFrame):
                 if draw_lbox or (draw_all_boxes and lbox > 0):
                     paint.fillRect(QRectF(x,3+y*self.fontht, self.geometry().width()-x, self.fontht), color)
 
-                self.lines[line].width = x / self.fontwt
+                self.lines.set_width(line, x / self.fontwt)
                 x = 0#l_x[-1]
                 y += self.lines[line].height
                 line += 1
-                self.lines[line].height = 1 # reset height
+                self.lines.set_height(line, 1) # reset height
 
             # draw cursor
             if node is self.cursor.node and self.show_cursor:
@@ -650,9 +638,7 @@ class NodeEditor(QFrame):
             self.update()
 
     def cursor_to_coordinate(self):
-        y = 0
-        for l in self.tm.lines[:self.cursor.line]:
-            y += l.height * self.fontht
+        y = self.tm.lines.get_top(self.cursor.line) * self.fontht
         x = self.tm.cursor.get_x() * self.fontwt
         y = y - self.getScrollArea().verticalScrollBar().value() * self.fontht
         return (x,y)
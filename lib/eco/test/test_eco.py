@@ -20,11 +20,11 @@
 # IN THE SOFTWARE.
 
 from grammars.grammars import calc, java, python, Language, sql, pythonprolog, lang_dict, phppython, pythonphp
-from treemanager import TreeManager
+from treemanager import TreeManager, Line, LineTable
 from incparser.incparser import IncParser
 from inclexer.inclexer import IncrementalLexer
-from incparser.astree import BOS, EOS
-from grammar_parser.gparser import MagicTerminal
+from incparser.astree import BOS, EOS, TextNode
+from grammar_parser.gparser import MagicTerminal, IndentationTerminal, Nonterminal
 
 from PyQt4 import QtCore
 
@@ -537,6 +537,24 @@ class Test_Helper:
     def move(self, direction, times):
         for i in range(times): self.treemanager.cursor_movement(direction)
 
+    def check_tree(self):
+        """Checks that walking the children of the tree reaches the same
+        terminals as following next_term."""
+        root = self.parser.previous_version.parent
+        terminals = []
+        todo = [root]
+        while todo:
+            node = todo.pop()
+            if isinstance(node.symbol, Nonterminal):
+                todo.extend(reversed(node.children))
+            else:
+                terminals.append(node)
+        node = root.children[0]
+        for terminal in terminals:
+            assert terminal is node
+            node = node.next_term
+        assert node is None
+
     def tree_compare(self, node1, node2):
         # XXX: test references (next_term, parent, lookup)
         while True:
@@ -599,6 +617,25 @@ class Test_Helper:
         with pytest.raises(AssertionError):
             self.tree_compare(parser1.previous_version.parent, parser2.previous_version.parent)
 
+    def test_batch_parse(self):
+        t1 = TreeManager()
+        parser1, lexer1 = python.load()
+        t1.add_parser(parser1, lexer1, python.name)
+        t1.import_file(programs.connect4)
+        assert parser1.last_status == True
+
+        # parse the same input incrementally
+        t2 = TreeManager()
+        parser2, lexer2 = python.load()
+        t2.add_parser(parser2, lexer2, python.name)
+        t2.import_file(programs.connect4)
+        root2 = parser2.previous_version.parent
+        parser2.flatten(root2)
+        assert root2.children[1].symbol.name == "class"
+        assert parser2.inc_parse() == True
+
+        self.tree_compare(parser1.previous_version.parent, root2)
+
 class Test_Python(Test_Helper):
     def setup_class(cls):
         parser, lexer = python.load()
@@ -674,6 +711,887 @@ class Test_Bugs(Test_Python):
             self.treemanager.key_normal(c)
         assert self.parser.last_status == True
 
+    def test_reused_subtrees_unchanged(self):
+        self.reset()
+        self.treemanager.import_file("x = 1\ry = 2\r")
+        assert self.parser.last_status == True
+        states = {}
+        node = self.parser.previous_version.parent
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node.children:
+                states[node] = node.state
+                stack.extend(node.children)
+        self.treemanager.key_end()
+        self.treemanager.key_normal("3")
+        assert self.parser.last_status == True
+        assert len(self.parser.states) == len(self.parser.stack)
+        reused = [n for n in states if n.get_root() is self.parser.previous_version.parent]
+        assert reused
+        for node in reused:
+            assert node.state == states[node]
+
+    def test_error_isolation(self):
+        self.reset()
+        self.treemanager.import_file("x = 1\ry = 2\rz = 3\r")
+        assert self.parser.last_status == True
+        self.treemanager.key_end()
+        self.treemanager.key_normal(" ")
+        self.treemanager.key_normal("+")
+        assert self.parser.last_status == False
+        error_node = self.parser.error_node
+        assert error_node is not None
+        # edits after the error are still parsed into the tree
+        self.move("down", 2)
+        self.treemanager.key_end()
+        self.treemanager.key_normal("*")
+        self.treemanager.key_normal("4")
+        assert self.parser.last_status == False
+        assert self.parser.error_node is error_node
+        node = self.treemanager.cursor.node
+        assert node.symbol.name == "4"
+        assert node.parent.changed == False
+        # only the smallest subtrees around the error are tried
+        self.move("up", 2)
+        self.treemanager.key_end()
+        self.treemanager.key_normal("(")
+        candidates = self.parser.get_isolation_candidates(self.parser.error_node)
+        assert 0 < len(candidates) <= self.parser.isolation_limit
+        self.treemanager.key_backspace()
+        # fixing the error results in a valid parse again
+        self.treemanager.key_end()
+        self.treemanager.key_normal("5")
+        assert self.parser.last_status == True
+
+    def test_error_isolation_marked(self):
+        from astanalyser import AstAnalyser
+        from export import ATerms
+        self.reset()
+        self.treemanager.import_file("x = 1\ry = 2\rz = 3\r")
+        self.treemanager.key_end()
+        self.treemanager.save_current_version()
+        self.treemanager.key_normal(" ")
+        self.treemanager.key_normal("+")
+        assert self.parser.last_status == False
+        # the subtree shifted around the error is reported as an error and
+        # has no AST
+        isolated = self.parser.isolated_error
+        assert isolated is not None
+        assert isolated.isolated
+        assert isolated.alternate is None
+        node = isolated.find_first_terminal()
+        assert node.symbol.name == "x"
+        assert self.treemanager.get_error(node).startswith("Not parsed due to the syntax error")
+        # which the analyser and the exporters skip
+        root = self.parser.previous_version.parent
+        analyser = AstAnalyser("grammars/python275.nb")
+        analyser.analyse(root)
+        assert sorted(n.name for n in analyser.data["variable"]) == ["y", "z"]
+        aterms = ATerms.export(root)
+        assert "'y'" in aterms
+        assert "'x'" not in aterms
+        self.treemanager.save_current_version()
+        # fixing the error clears the mark
+        self.treemanager.key_backspace()
+        self.treemanager.key_backspace()
+        assert self.parser.last_status == True
+        assert self.parser.isolated_error is None
+        assert not isolated.isolated
+        self.treemanager.save_current_version()
+        # undo restores the mark along with the error
+        self.treemanager.key_ctrl_z()
+        assert self.parser.isolated_error is isolated
+        assert isolated.isolated
+        self.treemanager.key_ctrl_z()
+        assert self.parser.isolated_error is None
+        assert not isolated.isolated
+        assert isolated.alternate is not None
+
+    def test_import_error(self):
+        self.reset()
+        self.treemanager.import_file("x = (1\ry = 2\r")
+        assert self.parser.last_status == False
+        # the terminals are left below the root
+        root = self.parser.previous_version.parent
+        assert root.children[1].symbol.name == "x"
+        self.treemanager.key_end()
+        self.treemanager.key_normal(")")
+        assert self.parser.last_status == True
+
+class Test_NodeReuse(Test_Python):
+
+    def get_stmts(self):
+        file_input = self.parser.previous_version.parent.children[1].children[1]
+        return file_input.alternate.get("stmts").children
+
+    def test_reuse_parents(self):
+        self.reset()
+        self.treemanager.import_file("x = 1\ry = 2\r")
+        stmts = self.get_stmts()
+        expr_stmt = stmts[0].children[0].children[0].children[0]
+        assert expr_stmt.symbol.name == "expr_stmt"
+        assert expr_stmt.alternate.get("rhs").get("val").symbol.name == "1"
+
+        self.treemanager.key_end()
+        self.treemanager.key_normal("2")
+        assert self.parser.last_status == True
+        # the rebuilt statement consists of the same nodes as before
+        assert self.get_stmts()[0] is stmts[0]
+        assert self.get_stmts()[1] is stmts[1]
+        assert stmts[0].children[0].children[0].children[0] is expr_stmt
+        assert expr_stmt.changed == False
+        assert expr_stmt.alternate.get("rhs").get("val").symbol.name == "12"
+
+    def test_reuse_undo(self):
+        self.reset()
+        self.treemanager.import_file("x = 1\ry = 2\r")
+        stmt = self.get_stmts()[0]
+        self.treemanager.key_end()
+        self.treemanager.key_normal("2")
+        self.treemanager.save_current_version()
+        self.treemanager.key_normal(" ")
+        self.treemanager.key_normal("+")
+        self.treemanager.save_current_version()
+        assert self.parser.last_status == False
+        self.treemanager.key_ctrl_z()
+        assert self.treemanager.export_as_text() == "x = 12\ny = 2\n"
+        self.treemanager.key_ctrl_z()
+        assert self.treemanager.export_as_text() == "x = 1\ny = 2\n"
+        # the alternate is rebuilt from the restored nodes
+        assert self.get_stmts()[0].children[0] is stmt.children[0]
+
+    def goto(self, line, x):
+        self.treemanager.cursor.line = line
+        self.treemanager.cursor.move_to_x(x, self.treemanager.lines)
+
+    def test_reuse_undo_error(self):
+        # nodes reused by a later version get their flags back on undo, so
+        # the error they contain in the restored version isn't skipped
+        self.reset()
+        self.treemanager.import_file("class A:\r    def f(self):\r        x = 1\r        y = 2\r        return x\r\r    def g(self):\r        pass\r\rz = A()\rprint(z)\r")
+        self.goto(5, 0)
+        self.treemanager.key_normal(":")
+        self.treemanager.save_current_version()
+        self.goto(3, 3)
+        self.treemanager.key_normal("(")
+        self.treemanager.save_current_version()
+        self.goto(5, 1)
+        self.treemanager.key_backspace()
+        self.treemanager.save_current_version()
+        self.treemanager.key_ctrl_z()
+        self.treemanager.key_ctrl_z()
+        assert self.treemanager.export_as_text() == "class A:\n    def f(self):\n        x = 1\n        y = 2\n        return x\n:\n    def g(self):\n        pass\n\nz = A()\nprint(z)\n"
+        self.goto(11, 0)
+        self.treemanager.key_normal("x")
+        assert self.parser.last_status == False
+
+class Test_LazyAlternates(Test_Python):
+
+    def get_expr_stmt(self):
+        node = self.parser.previous_version.parent.children[0].next_term
+        while node.symbol.name != "expr_stmt":
+            node = node.parent
+        return node
+
+    def test_deferred(self):
+        self.reset()
+        self.treemanager.import_file("x = 1\ry = 2\r")
+        file_input = self.parser.previous_version.parent.children[1].children[1]
+        assert file_input.pending_alternate == True
+        assert self.get_expr_stmt().pending_alternate == True
+        file_input.alternate
+        assert file_input.pending_alternate == False
+        assert self.get_expr_stmt().pending_alternate == False
+
+        self.treemanager.key_end()
+        self.treemanager.key_normal(" ")
+        self.treemanager.key_normal("+")
+        self.treemanager.key_normal(" ")
+        self.treemanager.key_normal("2")
+        # the statement has been rebuilt, but not its alternate
+        expr_stmt = self.get_expr_stmt()
+        assert expr_stmt.pending_alternate == True
+        assert expr_stmt.alternate.get("rhs").name == "Plus"
+        assert expr_stmt.pending_alternate == False
+
+    def test_long_list(self):
+        self.reset()
+        self.treemanager.import_file("\r".join(["x = 1"] * 500))
+        file_input = self.parser.previous_version.parent.children[1].children[1]
+        assert len(file_input.alternate.get("stmts").children) == 500
+
+    def get_rhs(self):
+        file_input = self.parser.previous_version.parent.children[1].children[1]
+        stmt = file_input.alternate.get("stmts").children[0]
+        return stmt.children[0].children[0].children[0].alternate.get("rhs")
+
+    def test_undo(self):
+        self.reset()
+        self.treemanager.import_file("x = 1\ry = 2\r")
+        assert self.get_rhs().get("val").symbol.name == "1"
+        self.treemanager.key_end()
+        self.treemanager.key_normal(" ")
+        self.treemanager.key_normal("+")
+        self.treemanager.key_normal(" ")
+        self.treemanager.key_normal("2")
+        self.treemanager.save_current_version()
+        assert self.get_rhs().name == "Plus"
+        self.treemanager.key_ctrl_z()
+        assert self.treemanager.export_as_text() == "x = 1\ny = 2\n"
+        assert self.get_rhs().name == "Number"
+        assert self.get_rhs().get("val").symbol.name == "1"
+
+class Test_UndoDepth(Test_Python):
+
+    def type_lines(self, n):
+        texts = {}
+        for i in range(n):
+            self.treemanager.key_end()
+            for c in "\rx%s = %s" % (i, i):
+                self.treemanager.key_normal(c)
+            self.treemanager.save_current_version()
+            texts[self.treemanager.version] = self.treemanager.export_as_text()
+        return texts
+
+    def test_depth(self):
+        self.reset()
+        self.treemanager.import_file("a = 1")
+        self.treemanager.set_undo_depth(3)
+        texts = self.type_lines(10)
+        stats = self.treemanager.get_undo_stats()
+        assert stats["compactions"] > 0
+        assert stats["reclaimed"] > 0
+        assert stats["oldest"] == stats["newest"] - 3
+        for i in range(5):
+            self.treemanager.key_ctrl_z()
+            assert self.treemanager.export_as_text() == texts[self.treemanager.version]
+        assert self.treemanager.version == stats["oldest"]
+        for i in range(3):
+            self.treemanager.key_shift_ctrl_z()
+            assert self.treemanager.export_as_text() == texts[self.treemanager.version]
+
+    def test_edit_after_undo(self):
+        self.reset()
+        self.treemanager.import_file("a = 1")
+        self.treemanager.set_undo_depth(2)
+        self.type_lines(6)
+        self.treemanager.key_ctrl_z()
+        self.treemanager.key_ctrl_z()
+        texts = self.type_lines(6)
+        assert self.parser.last_status
+        for i in range(3):
+            self.treemanager.key_ctrl_z()
+        assert self.treemanager.version == self.treemanager.get_undo_stats()["oldest"]
+        assert self.treemanager.export_as_text() == texts[self.treemanager.version]
+
+    def test_default(self):
+        self.reset()
+        assert self.treemanager.undo_depth == 1000
+        self.treemanager.import_file("a = 1")
+        self.treemanager.set_undo_depth(50)
+        texts = self.type_lines(60)
+        stats = self.treemanager.get_undo_stats()
+        assert stats["oldest"] == stats["newest"] - 50
+        # old versions are merged in batches of 5, not after every version
+        assert 0 < stats["compactions"] <= 3
+        for i in range(55):
+            self.treemanager.key_ctrl_z()
+        assert self.treemanager.version == stats["oldest"]
+        assert self.treemanager.export_as_text() == texts[self.treemanager.version]
+
+    def test_unlimited(self):
+        self.reset()
+        self.treemanager.set_undo_depth(None)
+        self.treemanager.import_file("a = 1")
+        self.type_lines(5)
+        for i in range(5):
+            self.treemanager.key_ctrl_z()
+        assert self.treemanager.export_as_text() == "a = 1"
+        assert self.treemanager.get_undo_stats()["reclaimed"] == 0
+
+    def test_changed_nodes(self):
+        self.reset()
+        lines = ["x%s = %s" % (i, i) for i in range(50)]
+        self.treemanager.import_file("\r".join(lines))
+        self.treemanager.key_end()
+        self.treemanager.key_normal("2")
+        version = self.treemanager.version
+        self.treemanager.save_current_version()
+        changed = self.treemanager.get_changed_nodes(version)
+        # only the edited line and its ancestors are saved
+        nodes = 0
+        todo = [self.treemanager.get_bos().parent]
+        while todo:
+            node = todo.pop()
+            nodes += 1
+            todo.extend(node.children)
+        assert 0 < len(changed) < nodes / 4
+        assert self.treemanager.get_max_version() == version + 1
+        self.treemanager.key_ctrl_z()
+        assert self.treemanager.export_as_text() == "\n".join(lines)
+        self.treemanager.key_shift_ctrl_z()
+        assert self.treemanager.export_as_text() == "\n".join(["x0 = 02"] + lines[1:])
+        self.treemanager.key_ctrl_z()
+        self.treemanager.key_end()
+        self.treemanager.key_normal("4")
+        assert self.treemanager.get_max_version() == version
+        assert self.treemanager.export_as_text() == "\n".join(["x0 = 04"] + lines[1:])
+
+    def test_changed_nodes_two_trees(self):
+        # each tree manager only records the changes of its own tree
+        self.reset()
+        self.treemanager.import_file("a = 1")
+        texts = self.type_lines(2)
+        parser, lexer = python.load()
+        parser.init_ast()
+        other = TreeManager()
+        other.add_parser(parser, lexer, python.name)
+        other.set_font_test(7, 17)
+        other.import_file("b = 2")
+        other.key_end()
+        other.key_normal("3")
+        other.save_current_version()
+        texts.update(self.type_lines(2))
+        version = self.treemanager.version
+        own = set()
+        for node in self.treemanager.get_changed_nodes(version - 1):
+            own.add(id(node))
+        for node in other.get_changed_nodes(other.version - 1):
+            assert id(node) not in own
+        for i in range(3):
+            self.treemanager.key_ctrl_z()
+            assert self.treemanager.export_as_text() == texts[self.treemanager.version]
+        other.key_ctrl_z()
+        assert other.export_as_text() == "b = 2"
+        self.treemanager.key_shift_ctrl_z()
+        assert self.treemanager.export_as_text() == texts[self.treemanager.version]
+
+class Test_EditTransaction(Test_Python):
+
+    def count_parses(self):
+        self.parses = 0
+        inc_parse = self.parser.inc_parse
+        def counting_inc_parse(*args):
+            self.parses += 1
+            return inc_parse(*args)
+        self.parser.inc_parse = counting_inc_parse
+
+    def teardown_method(self, method):
+        if "inc_parse" in self.parser.__dict__:
+            del self.parser.inc_parse
+
+    def test_single_parse(self):
+        self.reset()
+        self.treemanager.import_file("a = 1\rb = 2")
+        self.count_parses()
+        self.treemanager.begin_edit()
+        self.treemanager.key_end()
+        for c in "\rdef x():\r    return 3":
+            self.treemanager.key_normal(c)
+        self.treemanager.key_backspace()
+        assert self.parses == 0
+        self.treemanager.commit()
+        assert self.parses == 1
+        assert self.parser.last_status
+        assert self.treemanager.export_as_text() == "a = 1\ndef x():\n    return \nb = 2"
+
+    def test_nested(self):
+        self.reset()
+        self.count_parses()
+        self.treemanager.begin_edit()
+        self.treemanager.begin_edit()
+        for c in "x = 1":
+            self.treemanager.key_normal(c)
+        self.treemanager.commit()
+        assert self.parses == 0
+        self.treemanager.commit()
+        assert self.parses == 1
+        assert self.parser.last_status
+
+    def test_save_parses_pending_edits(self):
+        self.reset()
+        self.treemanager.begin_edit()
+        for c in "x = 1":
+            self.treemanager.key_normal(c)
+        self.treemanager.save_current_version()
+        assert self.parser.last_status
+        self.count_parses()
+        self.treemanager.commit()
+        assert self.parses == 0
+
+class Test_LineTable(object):
+
+    def setup_method(self, method):
+        self.blocksize = LineTable.blocksize
+        LineTable.blocksize = 4
+
+    def teardown_method(self, method):
+        LineTable.blocksize = self.blocksize
+
+    def check(self, table, lines):
+        assert len(table) == len(lines)
+        assert list(table) == lines
+        assert [table[i] for i in range(len(lines))] == lines
+        assert table.get_height() == sum([l.height for l in lines])
+        assert table.get_width() == max([l.width for l in lines] or [0])
+        row = 0
+        for i, l in enumerate(lines):
+            assert table.get_top(i) == row
+            assert table.find_row(row) == (i, row)
+            assert table.find_row(row + l.height - 1) == (i, row)
+            row += l.height
+
+    def test_insert_delete(self):
+        lines = [Line(i) for i in range(30)]
+        table = LineTable(lines[:10])
+        table.insert_lines(5, lines[10:])
+        expected = lines[:5] + lines[10:] + lines[5:10]
+        self.check(table, expected)
+        del table[3:25]
+        del expected[3:25]
+        self.check(table, expected)
+        del table[0]
+        del expected[0]
+        self.check(table, expected)
+        table.append(lines[4])
+        expected.append(lines[4])
+        self.check(table, expected)
+        assert table[-1] is lines[4]
+
+    def test_heights_widths(self):
+        lines = [Line(i) for i in range(20)]
+        table = LineTable(lines)
+        table.set_height(7, 3)
+        table.set_width(12, 40)
+        table.set_width(2, 10)
+        self.check(table, lines)
+        assert table.get_width() == 40
+        table.set_width(12, 5)
+        assert table.get_width() == 10
+        assert table.find_row(8) == (7, 7)
+        assert table.find_row(10) == (8, 10)
+        assert table.find_row(100) == (19, 21)
+
+class Test_TextOffsets(Test_Python):
+
+    def check_offsets(self):
+        ast = self.parser.previous_version
+        text = self.treemanager.export_as_text()
+        assert ast.parent.text_length() == len(text)
+        for offset in range(len(text)):
+            node, start = ast.find_node_at_offset(offset)
+            assert start <= offset < start + len(node.symbol.name)
+            assert text[start:start + len(node.symbol.name)] == node.symbol.name.replace("\r", "\n")
+            assert ast.get_offset(node) == start
+            before = text[:offset]
+            line = before.count("\n")
+            assert ast.get_line_column(offset) == (line, offset - before.rfind("\n") - 1)
+        assert ast.find_node_at_offset(len(text)) == (None, None)
+
+    def test_import(self):
+        self.reset()
+        self.treemanager.import_file(programs.connect4)
+        self.check_offsets()
+
+    def test_edit(self):
+        self.reset()
+        self.treemanager.import_file(programs.connect4)
+        self.move("down", 5)
+        self.treemanager.key_end()
+        for c in "\r        x = 12":
+            self.treemanager.key_normal(c)
+        self.check_offsets()
+        self.move("down", 3)
+        self.treemanager.key_backspace()
+        self.treemanager.key_backspace()
+        self.check_offsets()
+
+    def test_undo(self):
+        self.reset()
+        self.treemanager.import_file(programs.connect4)
+        self.move("down", 5)
+        self.treemanager.key_end()
+        for c in "\r        x = 12":
+            self.treemanager.key_normal(c)
+        self.treemanager.save_current_version()
+        self.check_offsets()
+        self.treemanager.key_ctrl_z()
+        assert self.treemanager.export_as_text() == programs.connect4
+        self.check_offsets()
+
+    def test_failed_parse(self):
+        self.reset()
+        self.treemanager.import_file(programs.connect4)
+        self.check_offsets()
+        self.treemanager.pasteText("x = 1\rx = 1\rfoo(bar)))")
+        assert self.parser.last_status == False
+        self.check_offsets()
+        self.treemanager.key_normal("a")
+        self.check_offsets()
+        self.treemanager.key_ctrl_z()
+        assert self.treemanager.export_as_text() == programs.connect4
+        self.check_offsets()
+
+    def check_text_cache(self):
+        # cached lengths are up to date, and the nodes below a cached node
+        # are cached, too (see Node.invalidate_text)
+        todo = [(self.parser.previous_version.parent, False)]
+        while todo:
+            node, cached = todo.pop()
+            if isinstance(node.symbol, Nonterminal):
+                if node.textlength is None:
+                    assert not cached
+                else:
+                    cached = True
+                    assert node.textlength == sum(c.text_length() for c in self.get_terminals(node))
+                    if node.starts is not None:
+                        index, lengths, lines = node.starts
+                        assert len(index) == len(lengths) == len(node.children)
+                        for i, c in enumerate(node.children):
+                            assert index[id(c)] == i
+                            assert lengths[i] == sum(n.text_length() for n in node.children[:i])
+                            assert lines[i] == sum(n.newline_count() for n in node.children[:i])
+            for c in node.children:
+                todo.append((c, cached))
+
+    def get_terminals(self, node):
+        terminals = []
+        todo = [node]
+        while todo:
+            node = todo.pop()
+            if isinstance(node.symbol, Nonterminal):
+                todo.extend(node.children)
+            elif not isinstance(node.symbol, IndentationTerminal):
+                terminals.append(node)
+        return terminals
+
+    def test_failed_parse_cached(self):
+        # the lengths were cached before the parse failed
+        self.reset()
+        lines = ["x%s = %s" % (i, i) for i in range(200)]
+        self.treemanager.import_file("\r".join(lines))
+        self.check_offsets()
+        self.move("down", 100)
+        self.treemanager.key_end()
+        for c in " + (1":
+            self.treemanager.key_normal(c)
+        assert self.parser.last_status == False
+        self.check_text_cache()
+        self.check_offsets()
+        self.treemanager.key_normal(")")
+        assert self.parser.last_status == True
+        self.check_text_cache()
+        self.check_offsets()
+
+    def test_flat_root(self):
+        # a failed parse leaves all terminals directly under the root, whose
+        # children cache where they start (see TextNode.get_prefix)
+        self.reset()
+        lines = ["x%s = %s" % (i, i) for i in range(200)]
+        lines[100] = "x = (1"
+        self.treemanager.import_file("\r".join(lines))
+        assert self.parser.last_status == False
+        root = self.parser.previous_version.parent
+        assert len(root.children) > 1000
+        self.check_offsets()
+        self.check_text_cache()
+        ast = self.parser.previous_version
+        eos = root.children[-1]
+        last = eos.prev_term
+        calls = [0]
+        text_length = TextNode.text_length
+        def counted(node):
+            calls[0] += 1
+            return text_length(node)
+        TextNode.text_length = counted
+        cursor = self.treemanager.cursor
+        cursor.node = last
+        cursor.pos = 1
+        try:
+            offset = ast.get_offset(last)
+            assert ast.get_newlines_before(last) == 199
+            assert ast.get_line_offset(199) == offset - len("x199 = ")
+            assert ast.find_node_at_offset(offset) == (last, offset)
+            assert ast.find_node_at_offset(offset + 1) == (last, offset)
+            assert ast.find_node_at_offset(offset + 3) == (None, None)
+            assert cursor.get_x() == len("x199 = 1")
+        finally:
+            TextNode.text_length = text_length
+        assert calls[0] < 40
+        # editing keeps the cached starts up to date
+        self.move("down", 100)
+        self.treemanager.key_end()
+        self.treemanager.key_normal("2")
+        self.check_text_cache()
+        self.check_offsets()
+        self.treemanager.key_normal(")")
+        assert self.parser.last_status == True
+        self.check_text_cache()
+        self.check_offsets()
+
+    def test_nodes_at_position(self):
+        self.reset()
+        self.treemanager.import_file("x = 12\ry = 3")
+        ast = self.parser.previous_version
+        node, other = ast.get_nodes_at_position(5)
+        assert node.symbol.name == "12"
+        assert other is None
+        node, other = ast.get_nodes_at_position(6)
+        assert node.symbol.name == "12"
+        assert other is node.next_term
+        assert node.position == 4
+        assert ast.get_nodes_at_position(0)[0] is ast.get_bos()
+
+    def test_cursor_columns(self):
+        self.reset()
+        text = "x = [1, 2, 3]\ry = 1\r\rdef f():\r    return [100, 200]"
+        self.treemanager.import_file(text)
+        cursor = self.treemanager.cursor
+        for line, linetext in enumerate(text.split("\r")):
+            for x in range(len(linetext) + 3):
+                cursor.line = line
+                cursor.move_to_x(x, self.treemanager.lines)
+                column = min(x, len(linetext))
+                assert cursor.get_x() == column
+                if column > 0:
+                    assert linetext[:column].endswith(cursor.node.symbol.name[:cursor.pos])
+        cursor.line = 4
+        cursor.move_to_x(12, self.treemanager.lines)
+        assert cursor.node.symbol.name == "[" and cursor.pos == 1
+        self.move("up", 1)
+        assert cursor.line == 3
+        assert cursor.get_x() == 8
+        self.move("up", 1)
+        assert cursor.get_x() == 0
+        cursor.line = 0
+        cursor.move_to_x(13, self.treemanager.lines)
+        self.move("down", 1)
+        assert cursor.get_x() == 5
+        assert cursor.node.symbol.name == "1"
+
+    def test_image_count(self):
+        self.reset()
+        self.treemanager.import_file("x = 1\ry = 2")
+        ast = self.parser.previous_version
+        assert ast.parent.image_count() == 0
+        cursor = self.treemanager.cursor
+        cursor.line = 0
+        cursor.move_to_x(5, self.treemanager.lines)
+        node = cursor.node
+        assert node.symbol.name == "1"
+        node.image = "image"
+        assert ast.parent.image_count() == 1
+        # images are counted per tree
+        parser, lexer = python.load()
+        parser.init_ast()
+        assert parser.previous_version.parent.image_count() == 0
+        # removing the node removes its image from the count
+        cursor.move_to_x(0, self.treemanager.lines)
+        self.treemanager.key_cursors("down", mod_shift=True)
+        self.treemanager.key_delete()
+        assert self.treemanager.export_as_text() == "y = 2"
+        assert ast.parent.image_count() == 0
+
+class Test_BalancedLists(Test_Python):
+
+    def get_stmts(self):
+        file_input = self.parser.previous_version.parent.children[1].children[1]
+        assert file_input.symbol.name == "file_input"
+        return file_input.children[0]
+
+    def test_sequences(self):
+        # enabled for Python (see EcoFile.balance_lists)
+        names = [s[0].name for s in self.parser.sequences.values()]
+        assert "stmts" in names
+        assert "suite_loop" in names
+        # but not for other grammars
+        for grammar in [calc, java]:
+            parser, lexer = grammar.load()
+            assert parser.sequences == {}
+
+    def get_analysis(self, balanced):
+        from astanalyser import AstAnalyser
+        from export import ATerms
+        parser, lexer = python.load()
+        parser.set_balanced_sequences(balanced)
+        parser.init_ast()
+        treemanager = TreeManager()
+        treemanager.add_parser(parser, lexer, python.name)
+        treemanager.set_font_test(7, 17)
+        treemanager.import_file(programs.connect4)
+        root = parser.previous_version.parent
+        analyser = AstAnalyser("grammars/python275.nb")
+        analyser.analyse(root)
+        data = {}
+        for key, nodes in analyser.data.items():
+            data[key] = [(n.name, [str(p) for p in n.path]) for n in nodes]
+        return data, len(analyser.errors), ATerms.export(root)
+
+    def test_consumers(self):
+        # consumers of the tree see the same lists in either shape
+        balanced = self.get_analysis(True)
+        unbalanced = self.get_analysis(False)
+        assert balanced[0]
+        assert balanced == unbalanced
+
+    def test_import(self):
+        self.reset()
+        self.treemanager.import_file("\r".join(["x%s = %s" % (i, i) for i in range(200)]))
+        assert self.parser.last_status == True
+        stmts = self.get_stmts()
+        assert stmts.symbol.name == "stmts"
+        assert stmts.height == 8
+        # the AST still contains a flat list of statements
+        assert len(stmts.alternate.children) == 200
+
+    def test_insert_and_delete(self):
+        self.reset()
+        self.treemanager.import_file("\r".join(["x%s = %s" % (i, i) for i in range(200)]))
+        self.move("down", 100)
+        self.treemanager.key_end()
+        self.treemanager.key_normal("\r")
+        for c in "y = 1":
+            self.treemanager.key_normal(c)
+        assert self.parser.last_status == True
+        stmts = self.get_stmts()
+        assert stmts.height <= 10
+        assert len(stmts.alternate.children) == 201
+        assert stmts.alternate.children[101].find_first_terminal().symbol.name == "y"
+
+        for c in "y = 1\r":
+            self.treemanager.key_backspace()
+        assert self.parser.last_status == True
+        assert len(self.get_stmts().alternate.children) == 200
+
+    def test_undo(self):
+        self.reset()
+        program = "\r".join(["x%s = %s" % (i, i) for i in range(50)])
+        self.treemanager.import_file(program)
+        original = self.treemanager.export_as_text()
+        self.move("down", 20)
+        self.treemanager.key_end()
+        self.treemanager.key_normal("\r")
+        self.treemanager.key_normal("y")
+        self.treemanager.save_current_version()
+        inserted = self.treemanager.export_as_text()
+        self.move("down", 10)
+        self.treemanager.key_end()
+        for i in range(9):
+            self.treemanager.key_backspace()
+        self.treemanager.save_current_version()
+        deleted = self.treemanager.export_as_text()
+        assert self.parser.last_status == True
+
+        self.treemanager.key_ctrl_z()
+        assert self.treemanager.export_as_text() == inserted
+        self.treemanager.key_ctrl_z()
+        assert self.treemanager.export_as_text() == original
+        self.treemanager.key_shift_ctrl_z()
+        self.treemanager.key_shift_ctrl_z()
+        assert self.treemanager.export_as_text() == deleted
+        assert len(self.get_stmts().alternate.children) == 50
+
+class Test_CollapsedChains(Test_Python):
+
+    def setup_class(cls):
+        parser, lexer = python.load()
+        parser.set_collapsed_chains(True)
+        cls.lexer = lexer
+        cls.parser = parser
+        cls.parser.init_ast()
+        cls.ast = cls.parser.previous_version
+        cls.treemanager = TreeManager()
+        cls.treemanager.add_parser(cls.parser, cls.lexer, python.name)
+
+        cls.treemanager.set_font_test(7, 17) # hard coded. PyQt segfaults in test suite
+
+    def get_expr_stmt(self, i=0):
+        file_input = self.parser.previous_version.parent.children[1].children[1]
+        stmt = file_input.alternate.get("stmts").children[i]
+        # stmt ::= simple_stmt, simple_stmt ::= small_stmt ..., small_stmt ::= expr_stmt
+        return stmt.children[0].children[0].children[0]
+
+    def count_nodes(self, node):
+        count = 1
+        for c in node.children:
+            count += self.count_nodes(c)
+        return count
+
+    def test_chain(self):
+        self.reset()
+        self.treemanager.import_file("x = 1 + y\r")
+        assert self.parser.last_status == True
+        expr_stmt = self.get_expr_stmt()
+        assert expr_stmt.symbol.name == "expr_stmt"
+        assert [s.name for s in expr_stmt.chain] == ["expr_stmt_loop"]
+        lhs = expr_stmt.children[0]
+        assert lhs.symbol.name == "expr_stmt_loop"
+        assert lhs.chain[0].name == "testlist"
+        assert lhs.chain[-1].name == "atom"
+        assert lhs.children[0].symbol.name == "x"
+        rhs = expr_stmt.children[-1]
+        assert rhs.symbol.name == "testlist"
+        assert rhs.chain[-1].name == "arith_expr"
+        assert [c.symbol.name for c in rhs.children] == ["arith_expr", "+", "WS", "term"]
+
+        ast = expr_stmt.alternate
+        assert ast.name == "ExprStmtAssign"
+        assert ast.get("lhs").name == "Name"
+        assert ast.get("rhs").name == "Plus"
+        assert ast.get("rhs").get("lhs").get("val").symbol.name == "1"
+
+    def test_connect4(self):
+        self.reset()
+        self.treemanager.import_file(programs.connect4)
+        assert self.parser.last_status == True
+        root = self.parser.previous_version.parent
+
+        t = TreeManager()
+        parser, lexer = python.load()
+        t.add_parser(parser, lexer, python.name)
+        t.import_file(programs.connect4)
+        assert parser.last_status == True
+
+        assert self.count_nodes(root) < 0.7 * self.count_nodes(parser.previous_version.parent)
+        file_input = root.children[1].children[1]
+        assert repr(file_input.alternate) == repr(parser.previous_version.parent.children[1].children[1].alternate)
+
+    def test_edit(self):
+        self.reset()
+        self.treemanager.import_file("x = 1\ry = 2\r")
+        self.treemanager.key_end()
+        for c in " * z":
+            self.treemanager.key_normal(c)
+        assert self.parser.last_status == True
+        ast = self.get_expr_stmt().alternate
+        assert ast.get("rhs").name == "Mul"
+        assert ast.get("rhs").get("rhs").get("name").symbol.name == "z"
+        assert self.get_expr_stmt(1).alternate.get("rhs").name == "Number"
+
+        for c in " * z":
+            self.treemanager.key_backspace()
+        assert self.parser.last_status == True
+        assert self.get_expr_stmt().alternate.get("rhs").name == "Number"
+
+    def test_undo(self):
+        self.reset()
+        self.treemanager.import_file("x = 1\ry = 2\r")
+        original = self.treemanager.export_as_text()
+        self.treemanager.key_end()
+        for c in " + z":
+            self.treemanager.key_normal(c)
+        self.treemanager.save_current_version()
+        changed = self.treemanager.export_as_text()
+        self.treemanager.key_ctrl_z()
+        assert self.treemanager.export_as_text() == original
+        self.treemanager.key_shift_ctrl_z()
+        assert self.treemanager.export_as_text() == changed
+        for c in " + z":
+            self.treemanager.key_backspace()
+        assert self.parser.last_status == True
+        assert self.get_expr_stmt().alternate.get("rhs").name == "Number"
+
 class Test_Indentation(Test_Python):
 
     def test_indentation(self):
@@ -934,6 +1852,81 @@ if b:
         assert self.treemanager.cursor.node.symbol.name == "pass4"
         assert self.parser.last_status == True
 
+    def test_paste_many_lines(self):
+        self.reset()
+        self.treemanager.import_file("x = 1\ry = 2")
+        self.treemanager.key_end()
+        self.move("left", 1)
+        text = "".join(["2 + a%s\rz%s = " % (i, i) for i in range(200)])
+        self.treemanager.pasteText(text)
+        expected = ("x = " + text + "1\ry = 2").replace("\r", "\n")
+        assert self.treemanager.export_as_text() == expected
+        assert self.parser.last_status == True
+        assert len(self.treemanager.lines) == 202
+        assert self.treemanager.cursor.line == 200
+        for line in self.treemanager.lines[1:]:
+            assert line.node.symbol.name == "\r"
+        # all tokens were split as if the text had been typed
+        node = self.treemanager.get_bos().next_term
+        while node is not self.treemanager.get_eos():
+            assert node.symbol.name == "\r" or "\r" not in node.symbol.name
+            assert node.lookup != "" or isinstance(node.symbol, IndentationTerminal)
+            node = node.next_term
+
+    def test_paste_error(self):
+        # the children of nodes that were detached during the failed parse
+        # must be restored along with the links
+        self.reset()
+        self.treemanager.import_file("class A:\r    x = 1\r    y = 2\r")
+        self.treemanager.pasteText("x = 1\r(")
+        assert self.parser.last_status == False
+        self.check_tree()
+        self.treemanager.key_normal("a")
+        self.check_tree()
+
+        self.reset()
+        self.treemanager.import_file(programs.connect4)
+        self.treemanager.pasteText("x = 1\rx = 1\rfoo(bar)))")
+        assert self.parser.last_status == False
+        self.check_tree()
+
+    def test_delete_many_lines(self):
+        self.reset()
+        lines = ["x%s = %s" % (i, i) for i in range(200)]
+        self.treemanager.import_file("\r".join(lines))
+        self.treemanager.key_cursors("down")
+        self.treemanager.key_home()
+        self.treemanager.key_shift()
+        for i in range(198):
+            self.treemanager.key_cursors("down", mod_shift=True)
+        self.treemanager.key_delete()
+        assert self.treemanager.export_as_text() == "x0 = 0\nx199 = 199"
+        assert self.parser.last_status == True
+        assert len(self.treemanager.lines) == 2
+        assert self.treemanager.lines[1].node.symbol.name == "\r"
+        self.treemanager.key_ctrl_z()
+        assert self.treemanager.export_as_text() == "\n".join(lines)
+
+    def test_delete_lines_undo(self):
+        # the parents of removed terminals are restored by undo, too
+        self.reset()
+        inputstring = "class A:\r    def f(self):\r        x = 1\r        y = 2\r        return x\r\r    def g(self):\r        pass\r"
+        self.treemanager.import_file(inputstring)
+        self.move("down", 2)
+        self.treemanager.key_end()
+        self.treemanager.key_shift()
+        self.treemanager.key_cursors("down", mod_shift=True)
+        self.treemanager.key_delete()
+        self.check_tree()
+        self.treemanager.key_ctrl_z()
+        assert self.treemanager.export_as_text() == inputstring.replace("\r", "\n")
+        self.check_tree()
+        self.treemanager.key_shift_ctrl_z()
+        self.check_tree()
+        self.treemanager.key_ctrl_z()
+        assert self.treemanager.export_as_text() == inputstring.replace("\r", "\n")
+        self.check_tree()
+
     def test_bug(self):
         self.reset()
         inputstring = """class X(object):\rpass"""
@@ -1090,6 +2083,67 @@ def z():
         self.treemanager.key_normal("\"")
         assert self.parser.last_status == True
 
+    def get_indents(self, treemanager):
+        indents = []
+        node = treemanager.get_bos()
+        while node is not None:
+            if node.lookup == "<return>":
+                indents.append(node.indent)
+            node = node.next_term
+        return indents
+
+    def check_indents(self):
+        # the indentation stacks must be the same as after parsing from scratch
+        t = TreeManager()
+        parser, lexer = python.load()
+        t.add_parser(parser, lexer, python.name)
+        t.import_file(self.treemanager.export_as_text().replace("\n", "\r"))
+        assert self.get_indents(self.treemanager) == self.get_indents(t)
+
+    def count_whitespace_lookups(self):
+        self.lookups = 0
+        get_whitespace = self.parser.get_whitespace
+        def counting_get_whitespace(*args):
+            self.lookups += 1
+            return get_whitespace(*args)
+        self.parser.get_whitespace = counting_get_whitespace
+
+    def test_indentation_succeeding_lines(self):
+        # the lines after the edit keep their INDENT/DEDENT tokens, but their
+        # indentation stacks change and still need to be updated
+        self.reset()
+        lines = ["class X:", "    def f():"] + ["        x%s = %s" % (i, i) for i in range(30)] + ["y = 1"]
+        self.treemanager.import_file("\r".join(lines))
+        self.count_whitespace_lookups()
+        self.move("down", 1)
+        self.treemanager.key_home()
+        self.treemanager.key_normal(" ")
+        self.treemanager.key_normal(" ")
+        del self.parser.get_whitespace
+        assert self.parser.last_status == True
+        assert self.lookups >= 30
+        assert self.get_indents(self.treemanager)[2] == [0, 6, 8]
+        self.check_indents()
+
+    def test_indentation_succeeding_lines_unchanged(self):
+        # once a line's tokens and indentation stack are the same as before,
+        # the lines after it are left alone
+        self.reset()
+        lines = ["class X:", "    def f():", "        if a:"] + ["            x%s = %s" % (i, i) for i in range(30)] + ["y = 1"]
+        self.treemanager.import_file("\r".join(lines))
+        self.count_whitespace_lookups()
+        self.move("down", 3)
+        self.treemanager.key_home()
+        self.treemanager.key_normal(" ")
+        self.treemanager.key_normal(" ")
+        assert self.parser.last_status == False
+        self.treemanager.key_backspace()
+        self.treemanager.key_backspace()
+        del self.parser.get_whitespace
+        assert self.parser.last_status == True
+        assert self.lookups < 30
+        self.check_indents()
+
 class Test_NestedLboxWithIndentation():
     def setup_class(cls):
         parser, lexer = calc.load()
@@ -2450,3 +3504,21 @@ y = 13""":
         self.treemanager.key_normal("#")
         assert self.parser.last_status == True
         
+
+class Test_ExpectedSymbols(object):
+
+    def test_python(self):
+        # the expected symbols stored in the syntax table, which are used if
+        # the table was loaded from the cache, match those of the state graph
+        from grammar_parser.bootstrap import BootstrapParser
+        from jsonmanager import JsonManager
+        root, language, whitespaces = JsonManager(unescape=True).load(python.filename)[0]
+        bootstrap = BootstrapParser(lr_type=1, whitespaces=whitespaces)
+        bootstrap.ast = root
+        bootstrap.read_options()
+        bootstrap.create_parser()
+        parser = bootstrap.incparser
+        assert parser.graph is not None
+        for i in range(len(parser.graph.state_sets)):
+            expected = parser.graph.state_sets[i].get_next_symbols_no_ws()
+            assert parser.syntaxtable.get_expected_symbols(i) == expected
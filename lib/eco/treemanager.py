@@ -21,7 +21,7 @@
 
 from incparser.incparser import IncParser
 from inclexer.inclexer import IncrementalLexer
-from incparser.astree import TextNode, BOS, EOS, ImageNode, FinishSymbol
+from incparser.astree import AST, TextNode, BOS, EOS, ImageNode, FinishSymbol
 from grammar_parser.gparser import Terminal, MagicTerminal, IndentationTerminal, Nonterminal
 from PyQt4.QtGui import QApplication
 from grammars.grammars import lang_dict, Language, EcoFile
@@ -30,6 +30,7 @@ from export.simple_language import SimpleLanguageExporter
 from export.cpython import CPythonExporter
 
 import math
+from bisect import bisect_right
 
 class FontManager(object):
     def __init__(self):
@@ -54,6 +55,215 @@ class Line(object):
     def __repr__(self):
         return "Line(%s, width=%s, height=%s)" % (self.node, self.width, self.height)
 
+class LineTable(object):
+    """Sequence of the lines of a document. Lines are stored in blocks which
+    cache the sum of the heights and the maximum width of their lines. The
+    index and visual row at which each block starts are kept in prefix lists
+    that are only rebuilt after lines are added, removed or resized, so
+    lookups can bisect them instead of visiting every line. Heights and
+    widths must be changed through set_height/set_width to keep the blocks up
+    to date."""
+
+    blocksize = 512
+
+    def __init__(self, lines=()):
+        lines = list(lines)
+        n = self.blocksize
+        self.blocks = [lines[i:i+n] for i in range(0, len(lines), n)]
+        self.heights = [sum([l.height for l in block]) for block in self.blocks]
+        self.widths = [max([l.width for l in block]) for block in self.blocks]
+        self.length = len(lines)
+        self.starts = None # index of the first line of each block
+        self.tops = None   # visual row of the first line of each block
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for block in self.blocks:
+            for line in block:
+                yield line
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self.length))]
+        b, j = self.locate(i)
+        return self.blocks[b][j]
+
+    def __setitem__(self, i, value):
+        if isinstance(i, slice):
+            start, stop, _ = i.indices(self.length)
+            del self[start:stop]
+            self.insert_lines(start, value)
+            return
+        b, j = self.locate(i)
+        self.blocks[b][j] = value
+        self.update_block(b)
+
+    def __delitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self.length)
+            assert step == 1
+        else:
+            b, j = self.locate(i)
+            start = self.starts[b] + j
+            stop = start + 1
+        if start >= stop:
+            return
+        starts = self.get_starts()
+        self.length -= stop - start
+        first = b = bisect_right(starts, start) - 1
+        while start < stop:
+            block = self.blocks[b]
+            end = min(stop - starts[b], len(block))
+            del block[start - starts[b]:end]
+            start = starts[b] + end
+            b += 1
+        # drop emptied blocks and join small ones with their successor
+        for b in range(b - 1, first - 1, -1):
+            block = self.blocks[b]
+            if not block:
+                del self.blocks[b]
+                del self.heights[b]
+                del self.widths[b]
+                continue
+            if b + 1 < len(self.blocks) and len(block) + len(self.blocks[b+1]) <= self.blocksize:
+                block.extend(self.blocks[b+1])
+                del self.blocks[b+1]
+                del self.heights[b+1]
+                del self.widths[b+1]
+            self.update_block(b)
+        self.starts = None
+        self.tops = None
+
+    def append(self, line):
+        self.insert_lines(self.length, [line])
+
+    def insert(self, i, line):
+        self.insert_lines(i, [line])
+
+    def insert_lines(self, i, lines):
+        """Inserts the given lines before line `i`."""
+        lines = list(lines)
+        if not lines:
+            return
+        if i < 0:
+            i = max(0, i + self.length)
+        if not self.blocks:
+            self.blocks.append([])
+            self.heights.append(0)
+            self.widths.append(0)
+            b, j = 0, 0
+        elif i >= self.length:
+            b = len(self.blocks) - 1
+            j = len(self.blocks[b])
+        else:
+            b, j = self.locate(i)
+        block = self.blocks[b]
+        block[j:j] = lines
+        self.length += len(lines)
+        if len(block) > 2 * self.blocksize:
+            n = self.blocksize
+            new_blocks = [block[k:k+n] for k in range(0, len(block), n)]
+            self.blocks[b:b+1] = new_blocks
+            self.heights[b:b+1] = [sum([l.height for l in nb]) for nb in new_blocks]
+            self.widths[b:b+1] = [max([l.width for l in nb]) for nb in new_blocks]
+        else:
+            self.heights[b] += sum([l.height for l in lines])
+            if self.widths[b] is not None:
+                self.widths[b] = max(self.widths[b], max([l.width for l in lines]))
+        self.starts = None
+        self.tops = None
+
+    def update_block(self, b):
+        block = self.blocks[b]
+        self.heights[b] = sum([l.height for l in block])
+        self.widths[b] = max([l.width for l in block])
+        self.tops = None
+
+    def locate(self, i):
+        """Returns the block containing line `i` and the index of the line
+        within that block."""
+        if i < 0:
+            i += self.length
+        if i < 0 or i >= self.length:
+            raise IndexError("line index out of range")
+        starts = self.get_starts()
+        b = bisect_right(starts, i) - 1
+        return b, i - starts[b]
+
+    def get_starts(self):
+        if self.starts is None:
+            self.starts = []
+            i = 0
+            for block in self.blocks:
+                self.starts.append(i)
+                i += len(block)
+        return self.starts
+
+    def get_tops(self):
+        if self.tops is None:
+            self.tops = []
+            y = 0
+            for height in self.heights:
+                self.tops.append(y)
+                y += height
+        return self.tops
+
+    def set_height(self, i, height):
+        b, j = self.locate(i)
+        line = self.blocks[b][j]
+        if line.height != height:
+            self.heights[b] += height - line.height
+            line.height = height
+            self.tops = None
+
+    def set_width(self, i, width):
+        b, j = self.locate(i)
+        line = self.blocks[b][j]
+        if self.widths[b] is not None:
+            if width >= self.widths[b]:
+                self.widths[b] = width
+            elif line.width == self.widths[b]:
+                self.widths[b] = None # recomputed by get_width
+        line.width = width
+
+    def get_height(self):
+        """Returns the number of visual rows of all lines."""
+        return sum(self.heights)
+
+    def get_width(self):
+        """Returns the width of the widest line."""
+        for b in range(len(self.widths)):
+            if self.widths[b] is None:
+                self.widths[b] = max([l.width for l in self.blocks[b]])
+        return max(self.widths or [0])
+
+    def get_top(self, i):
+        """Returns the visual row at which line `i` starts."""
+        if i >= self.length:
+            return self.get_height()
+        b, j = self.locate(i)
+        return self.get_tops()[b] + sum([l.height for l in self.blocks[b][:j]])
+
+    def find_row(self, row):
+        """Returns the index of the line that is displayed at the given visual
+        row and the row at which that line starts. Rows below the last line
+        map to the last line."""
+        if self.length == 0:
+            return 0, 0
+        tops = self.get_tops()
+        b = max(0, bisect_right(tops, row) - 1)
+        y = tops[b]
+        block = self.blocks[b]
+        for j in range(len(block)):
+            if y + block[j].height > row:
+                break
+            if b == len(self.blocks) - 1 and j == len(block) - 1:
+                break
+            y += block[j].height
+        return self.get_starts()[b] + j, y
+
 class Cursor(object):
     def __init__(self, node, pos, line):
         self.node = node
@@ -72,6 +282,14 @@ class Cursor(object):
             if key > version:
                 del self.log[key]
 
+    def compact(self, version):
+        dropped = 0
+        for key in self.log.keys():
+            if key < version:
+                del self.log[key]
+                dropped += 1
+        return dropped
+
     def copy(self):
         return Cursor(self.node, self.pos, self.line)
 
@@ -196,6 +414,11 @@ class Cursor(object):
 
     def move_to_x(self, x, lines):
         node = lines[self.line].node
+        if x > 0:
+            found = self.find_column(node, x)
+            if found is not None:
+                self.node, self.pos = found
+                return
         while x > 0:
             newnode = self.find_next_visible(node)
             if newnode is node:
@@ -214,10 +437,42 @@ class Cursor(object):
         self.pos = len(node.symbol.name) + x
         self.node = node
 
+    def find_column(self, node, x):
+        """Returns the node and position at column `x` of the line starting
+        with `node`, using the text offsets cached in the tree. Returns None if
+        the tree contains nodes that are displayed as images, whose columns
+        the offsets don't give, or if the line can't be found in the tree."""
+        ast = self.get_ast(node)
+        if ast.parent.image_count() > 0:
+            return None
+        start = ast.get_line_offset(self.line)
+        if start is None:
+            return None
+        end = ast.get_line_offset(self.line + 1)
+        if end is None:
+            end = ast.parent.text_length()
+        else:
+            end -= 1 # before the newline
+        offset = min(start + x, end)
+        if offset == start:
+            return node, len(node.symbol.name)
+        found, nodestart = ast.find_node_at_offset(offset - 1)
+        if found is None:
+            return None
+        return found, offset - nodestart
+
     def get_x(self):
         if self.node.symbol.name == "\r" or isinstance(self.node, BOS):
             return 0
 
+        if not self.node.deleted:
+            ast = self.get_ast(self.node)
+            if ast.parent.image_count() == 0:
+                # without images the column is the distance to the line's start
+                start = ast.get_line_offset(ast.get_newlines_before(self.node))
+                if start is not None:
+                    return ast.get_offset(self.node) + self.pos - start
+
         if self.node.image and not self.node.plain_mode:
             x = self.get_nodesize_in_chars(self.node).w
         else:
@@ -231,6 +486,13 @@ class Cursor(object):
             node = self.find_previous_visible(node)
         return x
 
+    def get_ast(self, node):
+        """Returns the AST of the main language that contains `node`."""
+        root = node.get_root()
+        while root.get_magicterminal() is not None:
+            root = root.get_magicterminal().get_root()
+        return AST(root)
+
     def get_nodesize_in_chars(self, node):
         gfont = QApplication.instance().gfont
         if node.image:
@@ -275,7 +537,7 @@ class TreeManager(object):
     version = 1
 
     def __init__(self):
-        self.lines = []             # storage for line objects
+        self.lines = LineTable()    # storage for line objects
         self.mainroot = None        # root node (main language)
         #self.cursor = Cursor(0,0)
         #self.selection_start = Cursor(0,0)
@@ -286,10 +548,17 @@ class TreeManager(object):
         self.last_search = ""
         self.version = 1
         TreeManager.version = 1
+        self.max_version = 1
+        self.changed_nodes = {}     # version -> nodes changed in that version (see find_changed_nodes)
         self.last_saved_version = 1
         self.savenextparse = False
         self.saved_lines = {}
         self.saved_parsers = {}
+        self.undo_depth = 1000      # number of versions that can be undone (None: unlimited)
+        self.base_version = 1       # oldest version that can be restored
+        self.undo_stats = {"compactions": 0, "nodes": 0, "cursor": 0, "lines": 0, "parsers": 0, "status": 0}
+        self.edit_depth = 0         # number of open edit transactions (see begin_edit)
+        self.pending_parses = []    # [parser, batch] pairs postponed until the transaction is committed
 
         self.tool_data_is_dirty = False
 
@@ -311,6 +580,10 @@ class TreeManager(object):
         return False
 
     def log_input(self, method, *args):
+        # every edit operation starts by logging its input: make sure its
+        # changes are marked with the version of this tree manager, which
+        # may not be the last one that was used (see Node.save_ns)
+        TreeManager.version = self.version
         self.input_log.append("self.%s(%s)" % (method, ", ".join(args)))
 
     def set_font_test(self, width, height):
@@ -401,6 +674,9 @@ class TreeManager(object):
             # check for syntax error
             if node is p[0].error_node:
                 return "Syntax error on token '%s' (%s)." % (node.symbol.name, node.lookup)
+            if p[0].in_isolated_error(node) and p[0].error_node is not None:
+                error_node = p[0].error_node
+                return "Not parsed due to the syntax error on token '%s' (%s)." % (error_node.symbol.name, error_node.lookup)
             # check for namebinding error
             if p[3]:
                 error = p[3].get_error(node)
@@ -626,6 +902,7 @@ class TreeManager(object):
 
     def key_shift_ctrl_z(self):
         self.log_input("key_shift_ctrl_z")
+        self.parse_pending()
         if self.get_max_version() > self.version:
             self.version += 1
             TreeManager.version = self.version
@@ -633,23 +910,122 @@ class TreeManager(object):
             self.cursor.load(self.version)
 
     def get_max_version(self):
-        root = self.get_bos().parent
-        maxversion = 0
-        for (key, version) in root.log.keys():
-            maxversion = max(maxversion, version)
-        return maxversion
+        return self.max_version
+
+    def find_changed_nodes(self, version):
+        """Records the nodes of all parse trees that were changed in `version`.
+        The ancestors of a changed node are marked as well (see
+        Node.mark_changed), so only the marked subtrees are visited."""
+        nodes = self.changed_nodes.setdefault(version, [])
+        todo = [l[0].previous_version.parent for l in self.parsers]
+        while todo:
+            node = todo.pop()
+            for child in node.children:
+                if child.has_changes(version):
+                    nodes.append(child)
+                    todo.append(child)
+
+    def get_changed_nodes(self, version):
+        """Returns the nodes that were changed in `version`. These are the
+        nodes that are saved in the following version."""
+        nodes = []
+        seen = set()
+        for node in self.changed_nodes.get(version, []):
+            # a node can be recorded twice if `version` is saved again after
+            # an undo, and its marker may have been removed in between when a
+            # parse failed (see IncParser.do_undo)
+            if id(node) not in seen and node.has_changes(version):
+                seen.add(id(node))
+                nodes.append(node)
+        return nodes
 
     def key_ctrl_z(self):
         self.log_input("key_ctrl_z")
+        self.parse_pending()
         if self.mainroot.has_changes() and self.version == self.get_max_version():
             # if there are unsaved changes, save before undo so we can redo them again
             self.save_current_version()
-        if self.version > 1:
+        if self.version > self.get_min_version():
             self.version -= 1
             TreeManager.version = self.version
             self.cursor.load(self.version)
             self.recover_version("undo")
 
+    def get_min_version(self):
+        if self.undo_depth is None:
+            return self.base_version
+        return max(self.base_version, self.get_max_version() - self.undo_depth)
+
+    def set_undo_depth(self, depth):
+        """Limits the number of versions that can be undone. Older versions
+        are merged into a single base version, dropping their saved data."""
+        self.undo_depth = depth
+        if depth is not None:
+            self.compact_versions(self.get_min_version())
+
+    def get_undo_stats(self):
+        """Returns the range of versions that can be restored and the number
+        of saved entries that were dropped by merging old versions."""
+        stats = dict(self.undo_stats)
+        stats["oldest"] = self.get_min_version()
+        stats["newest"] = self.get_max_version()
+        stats["depth"] = self.undo_depth
+        stats["reclaimed"] = sum(stats[key] for key in ["nodes", "cursor", "lines", "parsers", "status"])
+        return stats
+
+    def compact_versions(self, version):
+        """Merges all versions up to `version` into a single base version which
+        becomes the oldest version that can be restored."""
+        version = min(version, self.version)
+        if version <= self.base_version:
+            return
+        stats = self.undo_stats
+        stats["compactions"] += 1
+        stats["cursor"] += self.cursor.compact(version)
+
+        # keep the lines of the base version
+        keys = [key for key in self.saved_lines.keys() if key <= version]
+        if keys:
+            keys.remove(max(keys))
+        for key in keys:
+            del self.saved_lines[key]
+        stats["lines"] += len(keys)
+
+        # language boxes that were removed can still be restored by newer versions
+        parsers = {}
+        for l in self.parsers:
+            parsers[id(l[0])] = l[0]
+        for key in self.saved_parsers.keys():
+            if key < version:
+                del self.saved_parsers[key]
+                stats["parsers"] += 1
+            else:
+                for l in self.saved_parsers[key]:
+                    parsers[id(l[0])] = l[0]
+
+        nodes = []
+        for parser in parsers.values():
+            stats["status"] += parser.compact_status(version)
+            root = parser.previous_version.parent
+            nodes.extend([root, root.children[0], root.children[-1]])
+        # apart from the roots, only nodes changed in one of the merged
+        # versions have been saved more than once up to `version`
+        for v in self.changed_nodes.keys():
+            if v < version:
+                nodes.extend(self.changed_nodes.pop(v))
+        # the ancestors of an edit are changed in most versions, but only
+        # need to be compacted once
+        unique = {}
+        for node in nodes:
+            unique[id(node)] = node
+        for node in unique.values():
+            for (key, v) in node.log.keys():
+                if v < version:
+                    del node.log[(key, v)]
+            if node.history is not None:
+                stats["nodes"] += node.history.compact(version)
+        self.base_version = version
+
     def recover_version(self, direction):
         self.load_lines()
         self.load_parsers()
@@ -663,33 +1039,26 @@ class TreeManager(object):
             bos.load(self.version)
             eos = root.children[-1]
             eos.load(self.version)
-            node = self.pop_lookahead(bos)
-            while True:
-                if isinstance(node, EOS):
-                    break
-                prev_version = node.version
-                if direction == "undo":
-                    # recover old version if changes were made in that version
-                    if not node.has_changes(self.version):
-                        node = self.pop_lookahead(node)
-                        continue
-                elif direction == "redo":
-                    # recover newer version of node.version is smaller
-                    # however, if after reloading the version stays the same
-                    # we don't have to update the whole subtree
-                    if node.version < self.version:
-                        node.load(self.version)
-                        if node.version == prev_version:
-                            node = self.pop_lookahead(node)
-                            continue
-                node.load(self.version)
-                # continue with children
-                if len(node.children) > 0:
-                    node = node.children[0]
-                    continue
-                else:
-                    # skip subtree and continue otherwise
-                    node = self.pop_lookahead(node)
+        if direction == "undo":
+            # recover the nodes that were changed in the restored version
+            version = self.version
+        elif direction == "redo":
+            # recover the nodes that were saved in the restored version
+            version = self.version - 1
+        nodes = self.get_changed_nodes(version)
+        for node in nodes:
+            node.load(self.version)
+        # nodes changed in `version` that were removed from the tree before it
+        # was saved are only reachable through their recovered parents
+        seen = set(id(node) for node in nodes)
+        todo = nodes + [l[0].previous_version.parent for l in self.parsers]
+        while todo:
+            node = todo.pop()
+            for child in node.children:
+                if id(child) not in seen and child.has_changes(version):
+                    seen.add(id(child))
+                    child.load(self.version)
+                    todo.append(child)
 
     def pop_lookahead(self, la):
         while(la.right_sibling() is None):
@@ -697,7 +1066,6 @@ class TreeManager(object):
         return la.right_sibling()
 
     def clean_versions(self, version):
-        maxversion = self.get_max_version()
         # clean linenumbers
         for key in self.saved_lines.keys():
             if key > version:
@@ -710,24 +1078,24 @@ class TreeManager(object):
         for l in self.parsers:
             p = l[0]
             root = p.previous_version.parent
-            bos = root.children[0]
-            self.delete_versions_from(bos, version)
             self.delete_versions_from(root, version)
-            node = self.pop_lookahead(root.children[0])
-            while True:
-                if isinstance(node, EOS):
-                    break
-                self.delete_versions_from(node, version)
-                if len(node.children) > 0:
-                    node = node.children[0]
-                    continue
-                else:
-                    node = self.pop_lookahead(node)
+            self.delete_versions_from(root.children[0], version)
+            self.delete_versions_from(root.children[-1], version)
+        # nodes changed in `version` are saved in the versions after it
+        for v in self.changed_nodes.keys():
+            if v >= version:
+                for node in self.changed_nodes[v]:
+                    self.delete_versions_from(node, version)
+                if v > version:
+                    del self.changed_nodes[v]
+        self.max_version = version
 
     def delete_versions_from(self, node, version):
         for (key, v) in node.log.keys():
             if v > version:
                 del node.log[(key, v)]
+        if node.history is not None:
+            node.history.truncate(version)
 
     def save_lines(self):
         # check if lines have changed
@@ -737,8 +1105,8 @@ class TreeManager(object):
             return
 
         # check if nodes are different (e.g. we could delete and reinsert a line between saves)
-        for i in range(len(lines)):
-            if lines[i] is not self.lines[i]:
+        for old, new in zip(lines, self.lines):
+            if old is not new:
                 self.saved_lines[self.version] = list(self.lines)
                 return
 
@@ -764,7 +1132,7 @@ class TreeManager(object):
                 break
             except KeyError:
                 version -= 1
-        self.lines = list(l) # copy, otherwise saved list will be mutated
+        self.lines = LineTable(l) # copy, otherwise saved list will be mutated
 
     def save_parsers(self):
         self.saved_parsers[self.version] = list(self.parsers)
@@ -786,17 +1154,10 @@ class TreeManager(object):
             bos.save(self.version)
             eos = root.children[-1]
             eos.save(self.version)
-            node = self.pop_lookahead(bos)
-            while True:
-                if isinstance(node, EOS):
-                    node.save(self.version)
-                    break
-                if node.has_changes():
-                    node.save(self.version)
-                    if len(node.children) > 0:
-                        node = node.children[0]
-                        continue
-                node = self.pop_lookahead(node)
+        self.find_changed_nodes(TreeManager.version)
+        for node in self.get_changed_nodes(TreeManager.version):
+            node.save(self.version)
+        self.max_version = max(self.max_version, self.version)
 
     def key_home(self, shift=False):
         self.log_input("key_home", str(shift))
@@ -1016,7 +1377,8 @@ class TreeManager(object):
             internal_position = self.cursor.pos
             text1 = node.symbol.name[:internal_position]
             text2 = node.symbol.name[internal_position:]
-            node.symbol.name = text1
+            node.symbol.set_name(text1)
+            node.invalidate_text()
             node.insert_after(newnode)
 
             node2 = TextNode(Terminal(text2))
@@ -1083,7 +1445,7 @@ class TreeManager(object):
             incparser, inclexer = self.get_parser_lexer_for_language(language, True)
             incparser.previous_version.parent = root
             self.add_parser(incparser, inclexer, language.name)
-            lbox.symbol.name = "<%s>" % language
+            lbox.symbol.set_name("<%s>" % language)
 
             # reparse outer and inner box
             node = root.children[0].next_term
@@ -1166,7 +1528,8 @@ class TreeManager(object):
         self.log_input("pasteCompletion", repr(text))
         node = self.cursor.node
         if text.startswith(node.symbol.name):
-            node.symbol.name = text
+            node.symbol.set_name(text)
+            node.invalidate_text()
             self.cursor.pos = len(text)
         else:
             self.pasteText(text)
@@ -1203,7 +1566,8 @@ class TreeManager(object):
             node.insert(text, pos)
             self.cursor.node = node
 
-        self.relex(node)
+        # lex the pasted text in one go instead of relexing it incrementally
+        self.get_lexer(node.get_root()).relex_pasted(node)
         self.post_keypress("")
         self.reparse(node)
 
@@ -1233,21 +1597,30 @@ class TreeManager(object):
         if len(nodes) == 1:
             s = nodes[0].symbol.name
             s = s[:diff_start] + s[diff_end:]
-            nodes[0].symbol.name = s
+            nodes[0].symbol.set_name(s)
+            nodes[0].invalidate_text()
             self.delete_if_empty(nodes[0])
             self.clean_empty_lbox(nodes[0])
         else:
-            nodes[0].symbol.name = nodes[0].symbol.name[:diff_start]
-            nodes[-1].symbol.name = nodes[-1].symbol.name[diff_end:]
+            nodes[0].symbol.set_name(nodes[0].symbol.name[:diff_start])
+            nodes[-1].symbol.set_name(nodes[-1].symbol.name[diff_end:])
+            nodes[0].invalidate_text()
+            nodes[-1].invalidate_text()
             self.delete_if_empty(nodes[0])
             self.delete_if_empty(nodes[-1])
             self.clean_empty_lbox(nodes[0])
             self.clean_empty_lbox(nodes[-1])
+        # remove the nodes in between in runs of consecutive terminals
+        run = []
         for node in nodes[1:-1]:
             if isinstance(node, BOS) or isinstance(node, EOS):
                 continue
-            node.parent.remove_child(node)
-            self.clean_empty_lbox(node)
+            if run and run[-1].next_term is not node:
+                self.remove_run(run)
+                run = []
+            run.append(node)
+        if run:
+            self.remove_run(run)
         while True: # in case first node was deleted
             if isinstance(repair_node.next_term, EOS):
                 break
@@ -1268,6 +1641,10 @@ class TreeManager(object):
         self.selection_end = self.cursor.copy()
         self.changed = True
 
+    def remove_run(self, run):
+        run[0].remove_terminals(run[-1])
+        self.clean_empty_lbox(run[-1])
+
     def delete_if_empty(self, node):
         if node.symbol.name == "":
             node.parent.remove_child(node)
@@ -1306,11 +1683,12 @@ class TreeManager(object):
         except IndexError:
             next = self.get_eos()
 
+        # collect the new lines, so they can be inserted in one go
+        new_lines = []
         current = current.next_term
         while current is not next:
             if current.symbol.name == "\r":
-                y += 1
-                self.lines.insert(y, Line(current))
+                new_lines.append(Line(current))
             if isinstance(current.symbol, MagicTerminal):
                 current = current.symbol.ast.children[0]
             elif isinstance(current, EOS):
@@ -1320,6 +1698,7 @@ class TreeManager(object):
                     current = lbox.next_term
             else:
                 current = current.next_term
+        self.lines.insert_lines(y+1, new_lines)
 
     def delete_linebreak(self, y, node):
         current = self.lines[y].node
@@ -1362,7 +1741,7 @@ class TreeManager(object):
         root = new.get_root()
         lexer.relex_import(new, self.version+1)
         self.rescan_linebreaks(0)
-        self.reparse(bos)
+        self.reparse(bos, batch=True)
         self.save_current_version()
         self.changed = True
         return
@@ -1554,7 +1933,7 @@ class TreeManager(object):
         if self.last_saved_version < self.version:
             self.reparse(self.get_bos(), True)
 
-    def reparse(self, node, changed=True):
+    def reparse(self, node, changed=True, batch=False):
         if self.version < self.get_max_version():
             # we changed stuff after one or more undos
             # later versions are void -> delete
@@ -1563,25 +1942,79 @@ class TreeManager(object):
         if changed:
             root = node.get_root()
             parser = self.get_parser(root)
-            parser.inc_parse()
+            if self.edit_depth > 0:
+                self.queue_parse(parser, batch)
+            elif batch:
+                parser.batch_parse()
+            else:
+                parser.inc_parse()
+        TreeManager.version = self.version
+
+    def begin_edit(self):
+        """Starts an edit transaction. Until it is committed, every edit is
+        still relexed, but parsing is postponed so that all changes are
+        parsed together by a single run of each affected parser.
+        Transactions can be nested: only the outermost commit parses."""
+        self.log_input("begin_edit")
+        self.edit_depth += 1
+
+    def commit(self):
+        """Ends the edit transaction started by begin_edit."""
+        self.log_input("commit")
+        assert self.edit_depth > 0
+        self.edit_depth -= 1
+        if self.edit_depth == 0:
+            self.parse_pending()
+
+    def queue_parse(self, parser, batch):
+        for entry in self.pending_parses:
+            if entry[0] is parser:
+                entry[1] |= batch
+                return
+        self.pending_parses.append([parser, batch])
+
+    def parse_pending(self):
+        """Runs the parses postponed by an edit transaction."""
+        pending = self.pending_parses
+        self.pending_parses = []
+        for parser, batch in pending:
+            if not any(l[0] is parser for l in self.parsers):
+                # the language box was deleted in the meantime
+                continue
+            if batch:
+                parser.batch_parse()
+            else:
+                parser.inc_parse()
         TreeManager.version = self.version
 
     def save_current_version(self):
         self.log_input("save_current_version")
+        self.parse_pending()
         self.version += 1
         self.save()
         TreeManager.version = self.version
+        if self.undo_depth is not None:
+            # versions older than get_min_version can't be undone anymore, but
+            # are only merged once enough of them accumulated, since
+            # compact_versions visits all versions that are kept
+            if self.get_min_version() - self.base_version >= max(1, self.undo_depth // 10):
+                self.compact_versions(self.get_min_version())
 
     def full_reparse(self):
         for p in self.parsers:
-            p[0].reparse()
+            p[0].batch_parse()
 
     def apply_inputlog(self, inputlog):
-        for l in inputlog.split("\n"):
-            l = l.replace("\r", "\\r")
-            if l.startswith("#"):
-                continue
-            try:
-                eval(l) # expressions
-            except SyntaxError:
-                exec(l) # statements
+        # replay all edits in one transaction, so the log is parsed once
+        self.begin_edit()
+        try:
+            for l in inputlog.split("\n"):
+                l = l.replace("\r", "\\r")
+                if l.startswith("#"):
+                    continue
+                try:
+                    eval(l) # expressions
+                except SyntaxError:
+                    exec(l) # statements
+        finally:
+            self.commit()
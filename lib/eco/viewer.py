@@ -134,7 +134,7 @@ class Viewer(object):
 
         children = node.children
         if node.symbol.name == "Root":
-            children = node.log[("children", version)]
+            children = node.history.get_children(version)
         for c in children:
             key = ""
             if isinstance(node, AstNode):